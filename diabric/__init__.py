@@ -4,19 +4,39 @@ FABRIC UTILITY FUNCTIONS
 '''
 
 
+import base64
 import collections
+import grp
+import json
+import multiprocessing.pool
 import os
 import shutil
+import stat
 import subprocess
+import time
 
 import boto
 import fabric.api
 import fabric.contrib.files
 import fabric.operations
 from fabric.api import (env, task, sudo, run, cd, local, lcd, execute, get,
-                        put, settings)
+                        put, settings, hide)
 from fabric.contrib.files import exists, upload_template
 from fabric.contrib.project import rsync_project
+from fabric.utils import puts, warn
+
+from diabric.files import (file_unchanged, upload_dir, upload_many,
+                           restore_backups)
+from diabric.readiness import wait_ready, port_probe
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        # fall back to os.listdir
+        scandir = None
 
 
 def add_keyfile(keyfile):
@@ -39,7 +59,8 @@ def add_keyfile(keyfile):
         env.key_filename.append(keyfile)
 
 
-def fix_group_perms(path, group=None, remote=True):
+def fix_group_perms(path, group=None, remote=True, stamp=None, verbose=False,
+                    workers=8):
     '''
     Normalize the permissions of all files and directories within (and
     including) 'path'.  Specifically it:
@@ -56,23 +77,186 @@ def fix_group_perms(path, group=None, remote=True):
     Warning: adding group write permissions to ssh keys or a .ssh dir can cause
     ssh to complain and fail, since these keys are meant to be user specific.
 
+    All three fixes are made in a single traversal of path, and the paths
+    needing each fix are batched into as few chgrp and chmod processes as
+    possible, instead of one process per path.
+
     path: A directory.  The permissions of this directory and all dirs and 
     files within it will be normalized.
     group: the name or gid which should own each file and dir in path
     (including path.)
     remote: if True, path is assumed to be on a remote host.  Otherwise, path
-    is assumed to be on localhost.
+    is assumed to be on localhost, and fix_group_perms_local is used to fix
+    it without running any processes.
+    stamp: an optional path to a timestamp file, on the same host as path.
+    If stamp exists, only files and dirs whose status has changed since
+    stamp was last touched are checked.  stamp is touched after a successful
+    run, so the next run is incremental.  Use a different stamp for each
+    combination of path and group.
+    verbose: if True, list every file and dir that is changed.
+
+    workers: the number of threads used when remote is False.
+
+    Failing to fix some paths (e.g. ones owned by another user) produces a
+    warning, not an abort, and leaves stamp untouched.
+
+    Return: None if remote is True.  Otherwise the counts returned by
+    fix_group_perms_local.
     '''
-    doit = run if remote else local
+    if not remote:
+        return fix_group_perms_local(path, group=group, stamp=stamp,
+                                     verbose=verbose, workers=workers)
+
+    doit = run
 
+    # Each clause is evaluated for every path, using find's ',' operator.
+    # '-exec ... {} +' batches many paths into each chgrp or chmod.
+    ls = '-ls ' if verbose else ''
+    clauses = []
     if group:
         # all dirs and files should be owned by group 'genehawk'
-        doit(r'find {path} -type d -not -group {group} -ls -exec chgrp {group} {{}} \;'.format(path=path, group=group))
+        clauses.append(r'\( -type d -not -group {group} {ls}-exec chgrp {group} {{}} + \)')
     # all dirs should have setgid perms
-    doit(r'find {path} -type d -not -perm -g+s -ls -exec chmod g+s {{}} \;'.format(path=path))
+    clauses.append(r'\( -type d -not -perm -g+s {ls}-exec chmod g+s {{}} + \)')
     # all dirs and files should have group write perms if the user has write perms
-    doit(r'find {path} -perm -u+w -not -perm -g+w -ls -exec chmod g+w {{}} \;'.format(path=path))
+    clauses.append(r'\( -perm -u+w -not -perm -g+w {ls}-exec chmod g+w {{}} + \)')
+    find = 'find {path} {since}' + r'\( ' + ' , '.join(clauses) + r' \)'
+
+    if stamp:
+        # Touch a new stamp before traversing, so changes made during the
+        # traversal are checked next time.
+        since = '$(test -e {stamp} && echo -cnewer {stamp}) '.format(stamp=stamp)
+        cmd = 'touch {stamp}.new && ' + find + ' && mv {stamp}.new {stamp}'
+    else:
+        since = ''
+        cmd = find
+    with settings(warn_only=True):
+        doit(cmd.format(path=path, group=group, ls=ls, since=since,
+                        stamp=stamp))
+
+
+def fix_group_perms_local(path, group=None, stamp=None, verbose=False,
+                          workers=8):
+    '''
+    The local version of fix_group_perms.  Instead of running find and
+    forking chgrp and chmod processes, walk the tree using a pool of
+    `workers` threads, one directory per task, and fix each path with
+    os.chown and os.chmod.  Symbolic links are skipped, like find does.
+
+    See fix_group_perms for the other arguments.
+
+    Return: a collections.Counter of the number of paths whose group was
+    changed ('chgrp'), whose setgid bit was set ('setgid'), and to which group
+    write permission was added ('group_write'), and the number of paths that
+    could not be fixed ('errors').
+    '''
+    gid = None
+    if group is not None:
+        gid = int(group) if str(group).isdigit() else grp.getgrnam(group).gr_gid
+    since = None
+    if stamp and os.path.exists(stamp):
+        since = os.stat(stamp).st_mtime
+    start = time.time()
+
+    def fix(p, st, counts):
+        # check only paths whose status changed since the stamp
+        if since is not None and st.st_ctime <= since:
+            return
+        is_dir = stat.S_ISDIR(st.st_mode)
+        mode = stat.S_IMODE(st.st_mode)
+        new_mode = mode
+        fixes = []
+        if is_dir and gid is not None and st.st_gid != gid:
+            fixes.append('chgrp')
+        if is_dir and not mode & stat.S_ISGID:
+            new_mode |= stat.S_ISGID
+            fixes.append('setgid')
+        if mode & stat.S_IWUSR and not mode & stat.S_IWGRP:
+            new_mode |= stat.S_IWGRP
+            fixes.append('group_write')
+        if not fixes:
+            return
+        try:
+            if 'chgrp' in fixes:
+                os.chown(p, -1, gid)
+            if new_mode != mode:
+                os.chmod(p, new_mode)
+        except OSError as e:
+            warn('Unable to fix {}: {}'.format(p, e))
+            counts['errors'] += 1
+            return
+        counts.update(fixes)
+        if verbose:
+            puts(p)
+
+    def fix_dir(dirpath):
+        # Fix every entry in dirpath.  Return the subdirs and counts.
+        counts = collections.Counter()
+        subdirs = []
+        try:
+            if scandir:
+                entries = [(e.path, e.stat(follow_symlinks=False))
+                           for e in scandir(dirpath)]
+            else:
+                entries = [(p, os.lstat(p)) for p in
+                           (os.path.join(dirpath, n) for n in os.listdir(dirpath))]
+        except OSError as e:
+            warn('Unable to list {}: {}'.format(dirpath, e))
+            counts['errors'] += 1
+            return subdirs, counts
+        for p, st in entries:
+            if stat.S_ISLNK(st.st_mode):
+                continue
+            fix(p, st, counts)
+            if stat.S_ISDIR(st.st_mode):
+                subdirs.append(p)
+        return subdirs, counts
+
+    counts = collections.Counter()
+    st = os.lstat(path)
+    fix(path, st, counts)
+    level = [path] if stat.S_ISDIR(st.st_mode) else []
+
+    # walk the tree breadth-first, one level of directories at a time.
+    pool = multiprocessing.pool.ThreadPool(workers)
+    try:
+        while level:
+            next_level = []
+            for subdirs, dir_counts in pool.imap_unordered(fix_dir, level):
+                counts.update(dir_counts)
+                next_level.extend(subdirs)
+            level = next_level
+    finally:
+        pool.close()
+        pool.join()
+
+    if stamp and not counts['errors']:
+        with open(stamp, 'a'):
+            pass
+        os.utime(stamp, (start, start))
+
+    return counts
+
+
+
+def conf_specs(conf_files, conf_dir, mode=None):
+    '''
+    conf_files: a list of local configuration file paths, or of (local file
+    path, dest_name) pairs.  dest_name defaults to the basename of the local
+    file.
+    conf_dir: the remote dir the configuration files are uploaded to.
+    mode: if given, the mode of every uploaded file.
 
+    Return: a list of specs for diabric.files.upload_many.
+    '''
+    specs = []
+    for conf_file in conf_files:
+        filename, dest_name = (conf_file if isinstance(conf_file, tuple)
+                               else (conf_file, None))
+        dest = os.path.join(conf_dir, dest_name or os.path.basename(filename))
+        specs.append({'filename': filename, 'destination': dest,
+                      'mode': mode})
+    return specs
 
 
 #########
@@ -91,19 +275,48 @@ class Upstart(object):
         '''
         self.conf_dir = conf_dir
 
-    def conf_program(self, conf_file, dest_name=None, mode=None):
+    def conf_program(self, conf_file, dest_name=None, mode=None,
+                     skip_unchanged=False):
         '''
         conf_file: local upstart configuration file for the program.  If the
         program is named 'program', the basename of conf should be
         'program.conf'.
         dest_name: the base filename of the destination file.  Defaults to the
         basename of include_file.  E.g. myapp.conf.
+        skip_unchanged: if True, do not upload conf_file if the remote file
+        already has the same contents.
+
+        Return True if the configuration was uploaded and False if it was
+        skipped.  This can be used to avoid needlessly reloading the program:
+
+            if upstart.conf_program('myapp.conf', skip_unchanged=True):
+                upstart.reload_program('myapp')
         '''
         if not dest_name:
             dest_name = os.path.basename(conf_file)
 
         dest = os.path.join(self.conf_dir, dest_name)
+        if skip_unchanged and file_unchanged(conf_file, dest, use_sudo=True):
+            return False
+
         put(conf_file, dest, use_sudo=True, mode=mode)
+        return True
+
+    def conf_program_dir(self, local_dir, mode=None, prune=False):
+        '''
+        local_dir: a local directory of upstart program configuration files,
+        e.g. myapp.conf and myworker.conf.
+        mode: if given, the mode of every uploaded file.
+        prune: if True, or a glob pattern like '*.conf', remove files in
+        conf_dir that are not in local_dir.  See diabric.files.upload_dir.
+
+        Upload every file in local_dir to conf_dir as one archive, which is
+        much faster than calling conf_program for each file.
+
+        Return: a list of the uploaded file names.
+        '''
+        return upload_dir(local_dir, self.conf_dir, use_sudo=True, mode=mode,
+                          prune=prune)
 
     def reload_program(self, program):
         '''
@@ -122,12 +335,143 @@ class Upstart(object):
         # fyi: it is an error to start a running program
         sudo('initctl start {}'.format(program))
 
+    def apply(self, conf_files, mode=None):
+        '''
+        conf_files: a list of local upstart configuration files, or of (local
+        file path, dest_name) pairs, as for conf_program.  The name of each
+        program is the destination file name without the '.conf' extension.
+        mode: if given, the mode of every uploaded file.
+
+        Update many upstart programs at once:
+
+        - Upload the configuration files whose contents differ from the
+          remote files (with backups), using diabric.files.upload_many.
+        - If none changed, stop without reloading anything.
+        - Otherwise, in the same remote command that installs the files,
+          reload upstart's configuration once and restart only the programs
+          whose configuration changed.  Each program is restarted even if
+          another program fails to start.
+
+        Return: a list of the names of the restarted programs.
+        Raise: Exception if any program failed to start, after trying to
+        restart every program.
+        '''
+        def program(dest):
+            name = os.path.basename(dest)
+            return name[:-len('.conf')] if name.endswith('.conf') else name
+
+        def restart(destinations):
+            # fyi: it is an error to stop an already stopped program
+            cmds = ['initctl reload-configuration']
+            cmds += ['initctl stop {0} > /dev/null 2>&1; '
+                     'if initctl start {0}; then echo restarted: {0}; '
+                     'else echo failed: {0}; fi'.format(program(dest))
+                     for dest in destinations]
+            return '; '.join(cmds)
+
+        specs = conf_specs(conf_files, self.conf_dir, mode=mode)
+        changed = upload_many(specs, use_sudo=True, skip_unchanged=True,
+                              after=restart)
+        if not changed:
+            return []
+
+        results = {}
+        for line in changed.output.splitlines():
+            status, sep, name = line.partition(': ')
+            if status in ('restarted', 'failed'):
+                results[name.strip()] = status
+        programs = [program(dest) for dest in changed]
+        failed = [p for p in programs if results.get(p) != 'restarted']
+        restarted = [p for p in programs if p not in failed]
+        if failed:
+            raise Exception('Upstart programs failed to start.', failed,
+                            restarted)
+        return restarted
+
+    def is_running(self, program):
+        '''
+        Return True if upstart reports that program is running.
+        '''
+        with settings(hide('everything'), warn_only=True):
+            output = sudo('initctl status {}'.format(program))
+        return output.succeeded and 'start/running' in output
+
+    def wait_ready(self, program, timeout=60, probe=None):
+        '''
+        program: the name of the program to use in initctl commands.
+        timeout: the maximum number of seconds to wait.
+        probe: a check (see diabric.readiness) for when the program is ready,
+        e.g. port_probe(8000).  Defaults to checking that the program is
+        running.
+
+        Wait until program is ready, polling with exponential backoff, and
+        record the latency in diabric.readiness.latencies.
+
+        Return: the number of seconds waited.
+        Raise: diabric.readiness.NotReady if program is not ready in time.
+        '''
+        return wait_ready(probe or (lambda: self.is_running(program)),
+                          timeout=timeout)
+
 
 #############
 # SUPERVISORD
 # http://supervisord.org/index.html
 
 
+# Run on the remote host by Supervisord.multicall.
+MULTICALL_SCRIPT = '''
+import json
+try:
+    import xmlrpclib
+except ImportError:
+    import xmlrpc.client as xmlrpclib
+from supervisor.xmlrpc import SupervisorTransport
+
+args = json.loads({args!r})
+transport = SupervisorTransport(None, None, args['serverurl'])
+proxy = xmlrpclib.ServerProxy('http://127.0.0.1', transport)
+print(json.dumps(proxy.system.multicall(args['calls'])))
+'''
+
+
+# Run on the remote host by Supervisord.reload_programs(changed_only=True).
+# Reread the configuration, then make only the calls for the programs that
+# were added or changed (the first param of each call is the program).
+RELOAD_CHANGED_SCRIPT = '''
+import json
+try:
+    import xmlrpclib
+except ImportError:
+    import xmlrpc.client as xmlrpclib
+from supervisor.xmlrpc import SupervisorTransport
+
+args = json.loads({args!r})
+transport = SupervisorTransport(None, None, args['serverurl'])
+proxy = xmlrpclib.ServerProxy('http://127.0.0.1', transport)
+results = proxy.system.multicall([{{'methodName': 'supervisor.reloadConfig',
+                                    'params': []}}])
+programs = []
+if isinstance(results[0], list):
+    added, changed, removed = results[0][0]
+    programs = [p for p in args['programs'] if p in added or p in changed]
+    calls = [c for c in args['calls'] if c['params'][0] in programs]
+    if calls:
+        results += proxy.system.multicall(calls)
+print(json.dumps([programs, results]))
+'''
+
+
+def check_faults(results, *args):
+    '''
+    results: a list of multicall results.
+    Raise an exception if any of the results is a fault.
+    '''
+    faults = [r for r in results if isinstance(r, dict) and 'faultCode' in r]
+    if faults:
+        raise Exception('Supervisord call failed.', faults, *args)
+
+
 class Supervisord(object):
     '''
     Try to put a pretty interface on uploading configuration files for
@@ -139,14 +483,22 @@ class Supervisord(object):
     managing programs under those daemons.
     '''
 
-    def __init__(self, conf_file='/etc/supervisord.conf', include_dir='/etc/supervisor.d'):
+    def __init__(self, conf_file='/etc/supervisord.conf', include_dir='/etc/supervisor.d',
+                 serverurl='unix:///tmp/supervisor.sock', python='python2.7'):
         '''
         conf_file: the remote path to the main configuration file.
         include_dir: the remote path the the directory containing modular
         configuration files for supervisor programs, etc.
+        serverurl: the url of supervisord's XML-RPC interface on the remote
+        host, as in the [supervisorctl] section of the configuration.
+        Used by multicall.
+        python: the remote python executable that the supervisor package is
+        installed in.  Used by multicall.
         '''
         self.conf_file = conf_file
         self.include_dir = include_dir
+        self.serverurl = serverurl
+        self.python = python
 
     def install(self):
         '''
@@ -175,15 +527,24 @@ class Supervisord(object):
         # sudo('echo_supervisord_conf > supervisord.conf')
         put(conf_file, self.conf_file, use_sudo=True, mode=mode)
 
-    def conf_include(self, include_file, dest_name=None, mode=None):
+    def conf_include(self, include_file, dest_name=None, mode=None,
+                     skip_unchanged=False):
         '''
         include_file: the local file path of a modular configuration. E.g. the
         configuration of a specific program, like /path/to/myapp.conf.
         dest_name: the base filename of the destination file.  Defaults to the
         basename of include_file.  E.g. myapp.conf.
+        skip_unchanged: if True, do not upload include_file if the remote file
+        already has the same contents.
 
         Upload configuration to the include_dir.  Raise an exception if
         self.include_dir is falsy.
+
+        Return True if the configuration was uploaded and False if it was
+        skipped.  This can be used to avoid needlessly reloading a program:
+
+            if supervisord.conf_include('myapp.conf', skip_unchanged=True):
+                supervisord.reload_program('myapp')
         '''
         if not self.include_dir:
             raise Exception('No self.include_dir.  Can not upload program configuration without a defining a configuration dir.')
@@ -192,7 +553,32 @@ class Supervisord(object):
             dest_name = os.path.basename(include_file)
 
         dest = os.path.join(self.include_dir, dest_name)
+        if skip_unchanged and file_unchanged(include_file, dest, use_sudo=True):
+            return False
+
         put(include_file, dest, use_sudo=True, mode=mode)
+        return True
+
+    def conf_include_dir(self, local_dir, mode=None, prune=False):
+        '''
+        local_dir: a local directory of modular configuration files, e.g.
+        myapp.conf and myworker.conf.
+        mode: if given, the mode of every uploaded file.
+        prune: if True, or a glob pattern like '*.conf', remove files in
+        include_dir that are not in local_dir.  See
+        diabric.files.upload_dir.
+
+        Upload every file in local_dir to the include_dir as one archive,
+        which is much faster than calling conf_include for each file.  Raise
+        an exception if self.include_dir is falsy.
+
+        Return: a list of the uploaded file names.
+        '''
+        if not self.include_dir:
+            raise Exception('No self.include_dir.  Can not upload program configuration without a defining a configuration dir.')
+
+        return upload_dir(local_dir, self.include_dir, use_sudo=True,
+                          mode=mode, prune=prune)
 
     def reload(self):
         '''
@@ -205,14 +591,22 @@ class Supervisord(object):
         '''
         sudo('supervisorctl reload')
 
-    def reload_program(self, program):
+    def reload_program(self, program, rpc=False):
         '''
         program: the name of a supervisor 'program' section.
+        rpc: if True, send all the commands to supervisord's XML-RPC
+        interface with one multicall, which costs one remote round trip
+        instead of five.
 
         Reread supervisor's configuration and restart the program using the
         new configuration (if any).  Use this function to restart a program if
         its configuration has changed.
         '''
+        if rpc:
+            results = self.multicall([('supervisor.reloadConfig', [])] +
+                                     self.reload_calls(program))
+            check_faults(results[-2:], program)
+            return
 
         # supervisor docs are somewhat lacking for supervisorctl.
         # this is helpful
@@ -229,6 +623,119 @@ class Supervisord(object):
         # start the program
         sudo('supervisorctl start {}'.format(program))
 
+    def reload_programs(self, programs, changed_only=False):
+        '''
+        programs: a list of names of supervisor 'program' sections.
+        changed_only: if True, only restart the programs whose configuration
+        has changed (or that have been newly added).
+
+        Reread supervisor's configuration once and restart the programs using
+        the new configuration, with one remote command.  This is much faster
+        than calling reload_program for each program.  The programs are
+        started without waiting for each other, so they start concurrently.
+        If changed_only is True, the programs to restart are picked on the
+        remote host, after the reread, from the groups that it reports as
+        added or changed.
+
+        Return: a list of the programs that were restarted.
+        '''
+        if not programs:
+            return []
+
+        calls = [('supervisor.stopProcessGroup', [p]) for p in programs]
+        calls += [('supervisor.removeProcessGroup', [p]) for p in programs]
+        calls += [('supervisor.addProcessGroup', [p]) for p in programs]
+        # do not wait for each group to start before starting the next.
+        calls += [('supervisor.startProcessGroup', [p, False])
+                  for p in programs]
+        if changed_only:
+            programs, results = self.run_script(RELOAD_CHANGED_SCRIPT, calls,
+                                                programs=list(programs))
+            check_faults(results[:1])
+        else:
+            results = self.multicall([('supervisor.reloadConfig', [])] +
+                                     calls)
+        check_faults(results[-2 * len(programs):], programs)
+        return list(programs)
+
+    def is_running(self, program):
+        '''
+        Return True if supervisor reports that every process of program is
+        running.
+        '''
+        with settings(hide('everything'), warn_only=True):
+            output = sudo('supervisorctl status {}'.format(program))
+        lines = output.splitlines()
+        return bool(lines) and all(' RUNNING ' in l + ' ' for l in lines)
+
+    def wait_ready(self, program, timeout=60, probe=None):
+        '''
+        program: the name of a supervisor 'program' section.
+        timeout: the maximum number of seconds to wait.
+        probe: a check (see diabric.readiness) for when the program is ready,
+        e.g. http_probe('http://localhost:8000/').  Defaults to checking that
+        the program is running.
+
+        Wait until program is ready, polling with exponential backoff, and
+        record the latency in diabric.readiness.latencies.
+
+        Return: the number of seconds waited.
+        Raise: diabric.readiness.NotReady if program is not ready in time.
+        '''
+        return wait_ready(probe or (lambda: self.is_running(program)),
+                          timeout=timeout)
+
+    def reload_calls(self, program):
+        '''
+        program: the name of a supervisor 'program' section.
+
+        Return: a list of multicall calls which stop, remove, add and start
+        program, for use after supervisor.reloadConfig.  The calls for many
+        programs can be combined into one multicall.
+        '''
+        return [('supervisor.stopProcessGroup', [program]),
+                ('supervisor.removeProcessGroup', [program]),
+                ('supervisor.addProcessGroup', [program]),
+                ('supervisor.startProcessGroup', [program])]
+
+    def multicall(self, calls):
+        '''
+        calls: a list of (method name, params) pairs for supervisord's XML-RPC
+        interface.  E.g. [('supervisor.stopProcessGroup', ['myapp'])].  See
+        http://supervisord.org/api.html.
+
+        Make all the calls with one system.multicall request to supervisord,
+        using one remote command.  The request is sent over serverurl (usually
+        a unix socket) by a small script run by self.python on the remote
+        host.
+
+        Return: a list of the result of each call.  The result of a failed
+        call is a dict with 'faultCode' and 'faultString' keys.
+        '''
+        return self.run_script(MULTICALL_SCRIPT, calls)
+
+    def run_script(self, script, calls, **kws):
+        '''
+        script: a python script, like MULTICALL_SCRIPT, with an {args} field
+        for its JSON encoded arguments.
+        calls: a list of (method name, params) pairs, given to the script as
+        args['calls'].
+        kws: other arguments given to the script.
+
+        Run script with self.python on the remote host, using one remote
+        command.
+
+        Return: the JSON value printed on the last line of output.
+        '''
+        kws.update(serverurl=self.serverurl,
+                   calls=[{'methodName': name, 'params': params}
+                          for name, params in calls])
+        script = script.format(args=json.dumps(kws))
+        with settings(hide('stdout')):
+            output = sudo('echo {} | base64 --decode | {}'.format(
+                base64.b64encode(script), self.python))
+        return json.loads(output.splitlines()[-1])
+
 
 #######
 # NGINX
@@ -254,15 +761,24 @@ class Nginx(object):
     def start(self):
         sudo('service nginx start')
 
-    def conf_include(self, include_file, dest_name=None, mode=None):
+    def conf_include(self, include_file, dest_name=None, mode=None,
+                     skip_unchanged=False):
         '''
         include_file: the local file path of a modular configuration. E.g. the
         configuration of a specific program, like /path/to/myapp.conf.
         dest_name: the base filename of the destination file.  Defaults to the
         basename of include_file.  E.g. myapp.conf.
+        skip_unchanged: if True, do not upload include_file if the remote file
+        already has the same contents.
 
         Upload configuration to the include_dir.  Raise an exception if
         self.include_dir is falsy.
+
+        Return True if the configuration was uploaded and False if it was
+        skipped.  This can be used to avoid needlessly reloading nginx:
+
+            if nginx.conf_include('mysite.conf', skip_unchanged=True):
+                nginx.reload()
         '''
         if not self.include_dir:
             raise Exception('No self.include_dir.  Can not upload configuration without a defining a configuration dir.')
@@ -271,7 +787,32 @@ class Nginx(object):
             dest_name = os.path.basename(include_file)
 
         dest = os.path.join(self.include_dir, dest_name)
+        if skip_unchanged and file_unchanged(include_file, dest, use_sudo=True):
+            return False
+
         put(include_file, dest, use_sudo=True, mode=mode)
+        return True
+
+    def conf_include_dir(self, local_dir, mode=None, prune=False):
+        '''
+        local_dir: a local directory of modular configuration files, e.g.
+        myapp.conf and myworker.conf.
+        mode: if given, the mode of every uploaded file.
+        prune: if True, or a glob pattern like '*.conf', remove files in
+        include_dir that are not in local_dir.  See
+        diabric.files.upload_dir.
+
+        Upload every file in local_dir to the include_dir as one archive,
+        which is much faster than calling conf_include for each file.  Raise
+        an exception if self.include_dir is falsy.
+
+        Return: a list of the uploaded file names.
+        '''
+        if not self.include_dir:
+            raise Exception('No self.include_dir.  Can not upload configuration without a defining a configuration dir.')
+
+        return upload_dir(local_dir, self.include_dir, use_sudo=True,
+                          mode=mode, prune=prune)
 
     def reload(self):
         '''
@@ -281,6 +822,60 @@ class Nginx(object):
         '''
         sudo('service nginx reload')
 
+    def apply(self, includes, mode=None):
+        '''
+        includes: a list of local file paths of modular configurations, or
+        of (local file path, dest_name) pairs, as for conf_include.
+        mode: if given, the mode of every uploaded file.
+
+        Deploy includes as one transaction, with at most one reload of nginx:
+
+        - Upload the includes whose contents differ from the remote files
+          (with backups), using diabric.files.upload_many.
+        - If none changed, stop without testing or reloading nginx.
+        - Test the new configuration once with `nginx -t`.  If it fails,
+          restore the backups (removing new files) and raise an exception.
+        - Otherwise reload nginx once.
+
+        Raise an exception if self.include_dir is falsy.
+
+        Return: a list of the remote paths of the changed includes.  If it is
+        empty, nginx was not reloaded.
+        '''
+        if not self.include_dir:
+            raise Exception('No self.include_dir.  Can not upload configuration without a defining a configuration dir.')
+
+        specs = conf_specs(includes, self.include_dir, mode=mode)
+        changed = upload_many(specs, use_sudo=True, skip_unchanged=True)
+        if not changed:
+            return changed
+
+        with settings(warn_only=True):
+            result = sudo('nginx -t')
+        if result.failed:
+            restore_backups(changed, use_sudo=True)
+            raise Exception('Nginx configuration test failed.  Restored '
+                            'previous configuration.', changed, result)
+
+        self.reload()
+        return changed
+
+    def wait_ready(self, port=80, timeout=60, probe=None):
+        '''
+        port: the port nginx listens on.
+        timeout: the maximum number of seconds to wait.
+        probe: a check (see diabric.readiness) for when nginx is ready, e.g.
+        http_probe('http://localhost/').  Defaults to checking that nginx
+        is listening on port.
+
+        Wait until nginx is ready, polling with exponential backoff, and
+        record the latency in diabric.readiness.latencies.
+
+        Return: the number of seconds waited.
+        Raise: diabric.readiness.NotReady if nginx is not ready in time.
+        '''
+        return wait_ready(probe or port_probe(port), timeout=timeout)
+
 
 ##############
 # UNUSED TASKS
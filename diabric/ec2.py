@@ -1,5 +1,174 @@
 
+import bisect
+import collections
+import json
+import multiprocessing.pool
+import os
+import random
+import threading
+import time
+
 import boto
+import boto.ec2
+import boto.utils
+from boto.exception import EC2ResponseError
+
+from diabric.readiness import wait_until
+
+
+#############
+# CONNECTIONS
+
+
+class TokenBucket(object):
+    '''
+    A client-side rate limiter.  Tokens are added at rate tokens per second,
+    up to capacity tokens, and each API request takes one token, so requests
+    are allowed in bursts of up to capacity requests, but no faster than rate
+    requests per second on average.  A TokenBucket can be shared by threads.
+    '''
+
+    def __init__(self, rate=10, capacity=20):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        '''
+        Take tokens from the bucket, waiting until enough tokens are in it.
+        '''
+        # take the tokens at once, going into debt if there are too few, and
+        # sleep until the debt is repaid.  Later callers wait their turn
+        # behind the debt, so one sleep is always enough.
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+# The error codes EC2 returns when requests are being throttled.
+THROTTLING_CODES = ('RequestLimitExceeded', 'Throttling',
+                    'ThrottlingException')
+
+
+class ConnectionRegistry(object):
+    '''
+    Share EC2 connections among all the functions in this module, so that
+    credentials are resolved and TLS connections are set up once per region,
+    not once per call.  Requests made through call are rate limited per
+    region and retried with exponential backoff when EC2 throttles them.
+    '''
+
+    def __init__(self, rate=10, burst=20, retries=8, delay=0.5, max_delay=20):
+        '''
+        rate: the average number of requests per second sent to a region.
+        burst: the maximum number of requests sent to a region at once.
+        retries: the number of times a throttled request is retried.
+        delay: the number of seconds to wait before the first retry.  The
+        delay doubles after each retry, up to max_delay seconds, and is
+        jittered so that threads do not retry in lockstep.
+        '''
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.delay = delay
+        self.max_delay = max_delay
+        self.connections = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def connect(self, region=None, **credentials):
+        '''
+        region: a region name, e.g. 'us-west-2'.  Defaults to the region of
+        boto.connect_ec2().
+        credentials: keyword arguments for the connection, e.g.
+        aws_access_key_id and aws_secret_access_key.  Defaults to the
+        credentials boto finds in the environment and config files.
+
+        Return: the shared connection for region and credentials, creating
+        it the first time.
+        '''
+        key = (region, tuple(sorted(credentials.items())))
+        with self.lock:
+            if key not in self.connections:
+                if region is None:
+                    conn = boto.connect_ec2(**credentials)
+                else:
+                    conn = boto.ec2.connect_to_region(region, **credentials)
+                if conn is None:
+                    raise Exception('Unknown EC2 region.', region)
+                self.connections[key] = conn
+            return self.connections[key]
+
+    def bucket(self, conn):
+        '''
+        Return: the TokenBucket for the region of conn.
+        '''
+        region = getattr(getattr(conn, 'region', None), 'name', None)
+        with self.lock:
+            if region not in self.buckets:
+                self.buckets[region] = TokenBucket(self.rate, self.burst)
+            return self.buckets[region]
+
+    def call(self, conn, method, *args, **kws):
+        '''
+        conn: an EC2 connection, from connect or elsewhere.
+        method: the name of the connection method to call, e.g.
+        'get_all_instances'.
+
+        Call the method of conn with args and kws, waiting for the rate
+        limiter first, and retrying with backoff if EC2 throttles the
+        request.
+
+        Return: the return value of the method.
+        '''
+        bucket = self.bucket(conn)
+        delay = self.delay
+        for attempt in range(self.retries + 1):
+            bucket.acquire()
+            try:
+                return getattr(conn, method)(*args, **kws)
+            except EC2ResponseError as e:
+                if e.error_code not in THROTTLING_CODES or \
+                        attempt == self.retries:
+                    raise
+            time.sleep(delay * random.uniform(0.5, 1))
+            delay = min(delay * 2, self.max_delay)
+
+    def clear(self):
+        '''
+        Forget all shared connections and rate limiters.
+        '''
+        with self.lock:
+            self.connections.clear()
+            self.buckets.clear()
+
+
+# The registry shared by the functions in this module.
+registry = ConnectionRegistry()
+
+
+def connect(region=None, **credentials):
+    '''
+    Return: the shared connection for region and credentials.  See
+    ConnectionRegistry.connect.
+    '''
+    return registry.connect(region, **credentials)
+
+
+def call(conn, method, *args, **kws):
+    '''
+    Call a method of conn, rate limited and retried when throttled.  See
+    ConnectionRegistry.call.
+    '''
+    return registry.call(conn, method, *args, **kws)
 
 
 ###########
@@ -7,10 +176,12 @@ import boto
 
 
 def get_latest_on_instance(conn=None, instance_ids=None, filters=None,
-                           tags=None):
+                           tags=None, inventory=None):
     '''
     conn: an boto.ec2.connection.Connection object.  Defaults to
-    the connection from boto.connect_ec2().
+    the shared connection from connect().
+    inventory: an optional Inventory.  If given, instances are looked up in
+    the inventory, which returns InstanceRecord objects.
 
     Return: the "on" instance matching TAGS with the most recent launch time,
     or None if there are no instances matching the criteria.
@@ -18,7 +189,8 @@ def get_latest_on_instance(conn=None, instance_ids=None, filters=None,
     Raise: Exception if there is more than one non-terminated instance.
     '''
     instances = get_on_instances(conn=conn, instance_ids=instance_ids,
-                                 filters=filters, tags=tags)
+                                 filters=filters, tags=tags,
+                                 inventory=inventory)
     instances = sort_by_launch(instances)
     if not instances:
         return None
@@ -26,40 +198,74 @@ def get_latest_on_instance(conn=None, instance_ids=None, filters=None,
         return instances[-1]
 
 
-def get_on_instances(conn=None, instance_ids=None, filters=None, tags=None):
+def get_on_instances(conn=None, instance_ids=None, filters=None, tags=None,
+                     inventory=None):
     '''
     conn: an boto.ec2.connection.Connection object.  Defaults to
-    the connection from boto.connect_ec2().
+    the shared connection from connect().
+    inventory: an optional Inventory.  If given, instances are looked up in
+    the inventory, which returns InstanceRecord objects.
 
     Return all the "on" instances matching the default TAGS.
     '''
-    instances = get_instances(conn=conn, instance_ids=instance_ids,
-                              filters=filters, tags=tags)
+    if inventory is None:
+        instances = get_instances(conn=conn, instance_ids=instance_ids,
+                                  filters=filters, tags=tags)
+    else:
+        instances = inventory.instances(conn=conn, instance_ids=instance_ids,
+                                        filters=filters, tags=tags)
     instances = filter_by_on(instances)
     return instances
 
 
-def get_latest_on_host(conn=None, instance_ids=None, filters=None, tags=None):
+def get_latest_on_host(conn=None, instance_ids=None, filters=None, tags=None,
+                       inventory=None, cached=True):
     '''
+    inventory: an Inventory, used to avoid describing the instances again
+    when they were described recently.  Defaults to default_inventory, whose
+    lookups are reused for 5 minutes.  terminate_instances and
+    terminate_many clear it, but instances launched since a lookup are not
+    seen until it expires, so clear default_inventory after launching.
+    cached: if False and no inventory is given, describe the instances
+    without an inventory.
+
     Return the hostname/public dns name of the latest on instance or None if
     there is no such instance.
     '''
+    if inventory is None and cached:
+        inventory = default_inventory
     instance = get_latest_on_instance(conn=conn, instance_ids=instance_ids,
-                                      filters=filters, tags=tags)
+                                      filters=filters, tags=tags,
+                                      inventory=inventory)
     if instance:
         return instance.public_dns_name
     else:
         return None
 
 
-def get_on_hosts(conn=None, instance_ids=None, filters=None, tags=None):
+def get_on_hosts(conn=None, instance_ids=None, filters=None, tags=None,
+                 inventory=None, cached=True):
     '''
+    inventory: an Inventory, used to avoid describing the instances again
+    when they were described recently.  Defaults to default_inventory, whose
+    lookups are reused for 5 minutes.  terminate_instances and
+    terminate_many clear it, but instances launched since a lookup are not
+    seen until it expires, so clear default_inventory after launching.
+    cached: if False and no inventory is given, describe the instances
+    without an inventory.
+
     Return a list of hostnames/public dns names, one for each on instance
     matching the search criteria (instance_ids, filters, tags).
     '''
+    if inventory is None and cached:
+        inventory = default_inventory
     return [i.public_dns_name for i in 
             get_on_instances(conn=conn, instance_ids=instance_ids,
-                             filters=filters, tags=tags)]
+                             filters=filters, tags=tags, inventory=inventory)]
+
+
+# The states of instances that are not "on".
+OFF_STATES = ('terminated', 'shutting-down')
 
 
 def filter_by_on(instances):
@@ -68,8 +274,17 @@ def filter_by_on(instances):
     Filter out instances that are 'terminated' or 'shutting-down'.
     Return a list of the remaining instances.
     '''
-    bad_states = ['terminated', 'shutting-down']
-    return [i for i in instances if i.state not in bad_states]
+    return [i for i in instances if i.state not in OFF_STATES]
+
+
+def parse_launch_time(launch_time):
+    '''
+    launch_time: the launch_time of an instance, an ISO 8601 string like
+    '2013-01-31T12:00:00.000Z'.
+
+    Return: a datetime.datetime.
+    '''
+    return boto.utils.parse_ts(launch_time)
 
 
 def sort_by_launch(instances, desc=False):
@@ -80,34 +295,143 @@ def sort_by_launch(instances, desc=False):
     Return a list containing the instances in `instances` sorted by the
     launch_time attribute
     '''
-    return sorted(instances, key=lambda i: i.launch_time)
+    return sorted(instances, key=lambda i: parse_launch_time(i.launch_time),
+                  reverse=desc)
 
 
 def terminate_instances(instances, conn=None):
     '''
     Terminate instances.  Raise an exeption if not all instances are 
-    terminated.
+    terminated.  default_inventory is cleared.
 
     instances: a list of boto.ec2.instance.Instance objects.
     conn: an boto.ec2.connection.Connection object.  Defaults to
-    the connection from boto.connect_ec2().
+    the shared connection from connect().
     '''
-    conn = conn or boto.connect_ec2()
+    conn = conn or connect()
     if not instances:
         return
-    killed_instances = conn.terminate_instances([i.id for i in instances])
+    try:
+        killed_instances = call(conn, 'terminate_instances',
+                                [i.id for i in instances])
+    finally:
+        # cached lookups would still list the instances as on.
+        default_inventory.clear()
     if len(killed_instances) != len(instances):
         raise Exception('Not all instances terminated.', instances, 
                         killed_instances)
 
 
+class TerminateResult(collections.namedtuple('TerminateResult',
+                                             'id state error')):
+    '''
+    The outcome of terminating an instance with terminate_many.
+
+    id: the instance id.
+    state: the last state seen for the instance, or None.
+    error: the exception raised when terminating or polling the instance, or
+    a diabric.readiness.NotReady if the instance did not reach the
+    terminated state in time, or None.
+    '''
+    @property
+    def succeeded(self):
+        return self.error is None
+
+
+def terminate_many(instances, conn=None, chunk_size=500, max_workers=4,
+                   wait=True, timeout=600, delay=2, max_delay=30):
+    '''
+    instances: a list of boto.ec2.instance.Instance objects or instance ids.
+    conn: an boto.ec2.connection.Connection object.  Defaults to
+    the shared connection from connect().
+    chunk_size: the maximum number of instances terminated, or described,
+    in one request.
+    max_workers: the maximum number of chunks handled at the same time.
+    wait: if True, wait for the instances to reach the terminated state.
+    timeout: the maximum number of seconds to wait for a chunk.
+    delay: the number of seconds to wait before the first state poll.  The
+    delay doubles after each poll, up to max_delay seconds.
+
+    Terminate instances in chunks, handling the chunks concurrently, in a
+    pool of threads.  When waiting, the states of the instances in a chunk
+    are polled with one describe request per chunk.  Unlike
+    terminate_instances, a failure does not stop the other instances: if EC2
+    rejects some ids of a chunk as invalid, the chunk is split in halves
+    until the invalid ids are found, and the other instances are still
+    terminated.  Any other error fails only the instances of its chunk that
+    were not yet terminated.  default_inventory is cleared.
+
+    Return: an OrderedDict mapping each instance id to a TerminateResult.
+    '''
+    conn = conn or connect()
+    ids = [getattr(i, 'id', i) for i in instances]
+    if not ids:
+        return collections.OrderedDict()
+
+    def terminate_chunk(chunk):
+        # Return dicts of the last seen state and the error of instances.
+        states = {}
+        errors = {}
+
+        def terminate(ids):
+            try:
+                for i in call(conn, 'terminate_instances', ids):
+                    states[i.id] = i.state
+            except EC2ResponseError as e:
+                invalid = (e.error_code or '').startswith('InvalidInstanceID')
+                if not invalid or len(ids) == 1:
+                    errors.update((i, e) for i in ids)
+                    return
+                half = len(ids) // 2
+                terminate(ids[:half])
+                terminate(ids[half:])
+
+        def check():
+            pending = [i for i in chunk if i not in errors and
+                       states.get(i) != 'terminated']
+            if pending:
+                rs = call(conn, 'get_all_instances', instance_ids=pending)
+                states.update((i.id, i.state) for r in rs for i in r.instances)
+            return all(states.get(i) == 'terminated' for i in pending)
+
+        try:
+            terminate(chunk)
+            if wait:
+                wait_until(check, timeout=timeout, delay=delay,
+                           max_delay=max_delay)
+        except Exception as e:
+            # e.g. a server error, a socket error or NotReady.
+            for i in chunk:
+                done = (states.get(i) == 'terminated' if wait else
+                        i in states)
+                if i not in errors and not done:
+                    errors[i] = e
+        return states, errors
+
+    chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+    pool = multiprocessing.pool.ThreadPool(min(max_workers, len(chunks)))
+    try:
+        outcomes = pool.map(terminate_chunk, chunks)
+    finally:
+        pool.close()
+        pool.join()
+        # cached lookups would still list the instances as on.
+        default_inventory.clear()
+
+    results = collections.OrderedDict()
+    for chunk, (states, errors) in zip(chunks, outcomes):
+        for i in chunk:
+            results[i] = TerminateResult(i, states.get(i), errors.get(i))
+    return results
+
+
 def get_instances(conn=None, instance_ids=None, filters=None, tags=None):
     '''
     Find all instances matching the given instance ids, filters and tags.  
     Return a list of boto.ec2.instance.Instance objects
 
     conn: an boto.ec2.connection.Connection object.  Defaults to
-    the connection from boto.connect_ec2().
+    the shared connection from connect().
     instance_ids: a list of strings.  Retrict returned instances to only these
     instance ids.
     filters: a dict of key, value pairs used to filter the returned
@@ -123,7 +447,7 @@ def get_instances(conn=None, instance_ids=None, filters=None, tags=None):
     'webserver'}.  All tag keys are converted into filter tag keys and
     merged with `filters`.  Therefore 'Name' becomes 'tag:Name'.
     '''
-    conn = conn or boto.connect_ec2()
+    conn = conn or connect()
     if not (filters or tags):
         all_filters = None
     else:
@@ -133,7 +457,8 @@ def get_instances(conn=None, instance_ids=None, filters=None, tags=None):
         all_filters = filters.copy()
         all_filters.update(('tag:' + key, tags[key]) for key in tags)
 
-    rs = conn.get_all_instances(instance_ids=None, filters=filters)
+    rs = call(conn, 'get_all_instances', instance_ids=instance_ids,
+              filters=all_filters)
     return [i for r in rs for i in r.instances]
 
 
@@ -157,6 +482,381 @@ def print_instance(instance, use_repr=False):
         print '{}={}'.format(key, func(instance.__dict__[key]))
 
 
+#########
+# REGIONS
+
+
+def all_regions(conn=None):
+    '''
+    conn: an boto.ec2.connection.Connection object.  Defaults to
+    the shared connection from connect().
+
+    Return: a list of the names of the EC2 regions enabled for the account,
+    from DescribeRegions.  Unlike boto.ec2.regions(), this leaves out
+    regions that the account can not query, like cn-north-1 and
+    us-gov-west-1, which are in other partitions.
+    '''
+    conn = conn or connect()
+    return [r.name for r in call(conn, 'get_all_regions')]
+
+
+def connect_region(region):
+    '''
+    Return: the shared boto.ec2.connection.EC2Connection to region, e.g.
+    'us-west-2'.
+    '''
+    return connect(region)
+
+
+class RegionResults(list):
+    '''
+    The list of (region, result) pairs returned by map_regions and the
+    functions that use it.  The exception raised for each region that failed
+    is in the `errors` attribute, an OrderedDict keyed by region name.
+    '''
+    def __init__(self, pairs=(), errors=None):
+        list.__init__(self, pairs)
+        self.errors = errors or collections.OrderedDict()
+
+
+def map_regions(func, regions=None, max_workers=None, connect=None):
+    '''
+    func: a function called as func(conn) for each region, where conn is a
+    connection to the region.
+    regions: a list of region names.  Defaults to all_regions(), using the
+    connection returned by connect(None).
+    max_workers: the maximum number of regions to query at the same time.
+    Defaults to the number of regions.
+    connect: a function that returns a connection for a region name.
+    Defaults to connect_region.
+
+    Call func for every region concurrently, in a pool of threads.  An
+    error in one region, e.g. from credentials that are not valid there,
+    does not stop the other regions.
+
+    Return: a RegionResults list of (region, result) pairs, in the order of
+    regions, for the regions that succeeded.  Its errors attribute holds
+    the exception of each region that failed.
+    '''
+    connect = connect or connect_region
+    regions = all_regions(connect(None)) if regions is None else list(regions)
+    if not regions:
+        return RegionResults()
+
+    def call(region):
+        try:
+            return region, func(connect(region)), None
+        except Exception as e:
+            return region, None, e
+
+    pool = multiprocessing.pool.ThreadPool(max_workers or len(regions))
+    try:
+        outcomes = pool.map(call, regions)
+    finally:
+        pool.close()
+        pool.join()
+    return RegionResults(
+        [(region, result) for region, result, e in outcomes if e is None],
+        collections.OrderedDict((region, e) for region, result, e in outcomes
+                                if e is not None))
+
+
+def get_region_instances(regions=None, instance_ids=None, filters=None,
+                         tags=None, max_workers=None, connect=None):
+    '''
+    regions: a list of region names.  Defaults to all_regions().
+    max_workers: the maximum number of regions to query at the same time.
+    connect: a function that returns a connection for a region name.
+
+    Like get_instances, but query every region concurrently.  See
+    map_regions and get_instances.
+
+    Return: a RegionResults list of (region, instance) pairs, where instance
+    is a boto.ec2.instance.Instance object, with the errors of the regions
+    that failed.
+    '''
+    def func(conn):
+        return get_instances(conn=conn, instance_ids=instance_ids,
+                             filters=filters, tags=tags)
+    results = map_regions(func, regions, max_workers, connect)
+    return RegionResults([(region, i) for region, instances in results
+                          for i in instances], results.errors)
+
+
+def get_region_on_hosts(regions=None, instance_ids=None, filters=None,
+                        tags=None, max_workers=None, connect=None,
+                        inventory=None, cached=True):
+    '''
+    regions: a list of region names.  Defaults to all_regions().
+    max_workers: the maximum number of regions to query at the same time.
+    connect: a function that returns a connection for a region name.
+    inventory, cached: see get_on_hosts.  Lookups are cached per region.
+
+    Like get_on_hosts, but query every region concurrently.  See
+    map_regions.
+
+    Return: a RegionResults list of (region, hostname) pairs, one for each
+    on instance matching the search criteria (instance_ids, filters, tags),
+    with the errors of the regions that failed.
+    '''
+    def func(conn):
+        return get_on_hosts(conn=conn, instance_ids=instance_ids,
+                            filters=filters, tags=tags, inventory=inventory,
+                            cached=cached)
+    results = map_regions(func, regions, max_workers, connect)
+    return RegionResults([(region, host) for region, hosts in results
+                          for host in hosts], results.errors)
+
+
+
+###########
+# INVENTORY
+
+
+class InstanceRecord(collections.namedtuple(
+        'InstanceRecord', 'id state launch_time public_dns_name tags region')):
+    '''
+    The fields of a boto.ec2.instance.Instance that diabric uses.  Records
+    are small, and can be saved as JSON, so many of them can be cached.  They
+    can be used in place of instances by filter_by_on, sort_by_launch, etc.
+
+    tags: a dict of tag names and values.
+    region: the name of the region of the instance, or None.
+    '''
+    @classmethod
+    def from_instance(cls, instance):
+        region = getattr(instance, 'region', None)
+        return cls(instance.id, instance.state, instance.launch_time,
+                   instance.public_dns_name, dict(instance.tags or {}),
+                   getattr(region, 'name', region))
+
+
+class Inventory(object):
+    '''
+    A cache of the instances returned by get_instances, so that repeated
+    lookups do not describe every instance again.  Results are kept in
+    memory for ttl seconds and, if cache_file is given, in a JSON file, so
+    that they are also reused by the next fab invocation.
+    get_on_hosts and get_latest_on_host use default_inventory, unless they
+    are given another inventory or cached=False.
+
+    Usage example:
+
+        inventory = Inventory(ttl=300, cache_file='~/.diabric/ec2.json')
+        hosts = get_on_hosts(tags={'role': 'web'}, inventory=inventory)
+    '''
+
+    def __init__(self, ttl=300, cache_file=None):
+        '''
+        ttl: the number of seconds a lookup is cached for.
+        cache_file: an optional local path of a JSON file in which to cache
+        lookups between processes.
+        '''
+        self.ttl = ttl
+        self.cache_file = cache_file and os.path.expanduser(cache_file)
+        self.cache = {}
+        # lookups in several regions run in threads, see get_region_on_hosts.
+        self.lock = threading.Lock()
+
+    def key(self, conn=None, instance_ids=None, filters=None, tags=None):
+        region = getattr(getattr(conn, 'region', None), 'name', None)
+        return json.dumps([region, sorted(instance_ids or []), filters or {},
+                           tags or {}], sort_keys=True)
+
+    def instances(self, conn=None, instance_ids=None, filters=None,
+                  tags=None):
+        '''
+        Return a list of InstanceRecord objects, one for each instance
+        matching the given instance ids, filters and tags.  See
+        get_instances.  Only lookups older than ttl seconds describe the
+        instances again.
+        '''
+        key = self.key(conn, instance_ids, filters, tags)
+        now = time.time()
+        cached = self.cache.get(key)
+        if cached is None or now - cached[0] > self.ttl:
+            cached = self.load().get(key)
+        if cached is not None and now - cached[0] <= self.ttl:
+            self.cache[key] = cached
+            return list(cached[1])
+
+        records = [InstanceRecord.from_instance(i) for i in
+                   get_instances(conn=conn, instance_ids=instance_ids,
+                                 filters=filters, tags=tags)]
+        self.cache[key] = (now, records)
+        self.save(key)
+        return list(records)
+
+    def load(self):
+        '''
+        Return the lookups cached in cache_file, or {} if there are none.
+        '''
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file) as fh:
+                data = json.load(fh)
+        except ValueError:
+            return {}
+        return dict((key, (t, [InstanceRecord(*r) for r in records]))
+                    for key, (t, records) in data.items())
+
+    def save(self, key):
+        '''
+        Add the cached lookup for key to cache_file, dropping expired
+        lookups.  The file is replaced atomically, so concurrent fab
+        invocations never read a partly written file.
+        '''
+        if not self.cache_file:
+            return
+        with self.lock:
+            now = time.time()
+            cache = self.load()
+            cache[key] = self.cache[key]
+            data = dict((k, (t, [list(r) for r in records]))
+                        for k, (t, records) in cache.items()
+                        if now - t <= self.ttl)
+            dirname = os.path.dirname(self.cache_file)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            tmp = '{}.{}.tmp'.format(self.cache_file, os.getpid())
+            with open(tmp, 'w') as fh:
+                json.dump(data, fh)
+            os.rename(tmp, self.cache_file)
+
+    def clear(self):
+        '''
+        Forget all cached lookups, in memory and in cache_file.
+        '''
+        self.cache.clear()
+        if self.cache_file and os.path.exists(self.cache_file):
+            os.remove(self.cache_file)
+
+
+# The shared in-memory inventory used by get_on_hosts and get_latest_on_host,
+# so that the tasks of one fab run reuse each other's lookups.
+default_inventory = Inventory()
+
+
+#######
+# INDEX
+
+
+class InstanceIndex(object):
+    '''
+    Index instances, described once, by id, by state, by tag and by launch
+    time, so that looking up the latest instance with a tag or the on hosts
+    of a role does not rescan and re-sort every instance.
+
+    Usage example:
+
+        index = InstanceIndex.describe(inventory=inventory)
+        web_hosts = index.on_hosts('role', 'web')
+        db_host = index.latest('role', 'db').public_dns_name
+    '''
+
+    def __init__(self, instances):
+        '''
+        instances: a list of boto.ec2.instance.Instance or InstanceRecord
+        objects.  Instances are stored as InstanceRecord objects.
+        '''
+        records = [i if isinstance(i, InstanceRecord) else
+                   InstanceRecord.from_instance(i) for i in instances]
+        launched = sorted(((parse_launch_time(r.launch_time), r)
+                           for r in records), key=lambda pair: pair[0])
+        self.launch_times = [t for t, r in launched]
+        self.records = [r for t, r in launched]
+
+        # every list of records is sorted by launch time.
+        self.by_id = {}
+        self.by_state = collections.defaultdict(list)
+        self.on_by_tag = collections.defaultdict(list)
+        self.on = []
+        for r in self.records:
+            self.by_id[r.id] = r
+            self.by_state[r.state].append(r)
+            if r.state not in OFF_STATES:
+                self.on.append(r)
+                for key, value in r.tags.items():
+                    self.on_by_tag[(key, value)].append(r)
+
+    @classmethod
+    def describe(cls, conn=None, instance_ids=None, filters=None, tags=None,
+                 inventory=None):
+        '''
+        Return an index of the instances matching the given instance ids,
+        filters and tags, looked up in inventory if one is given.  See
+        get_instances.
+        '''
+        if inventory is None:
+            instances = get_instances(conn=conn, instance_ids=instance_ids,
+                                      filters=filters, tags=tags)
+        else:
+            instances = inventory.instances(
+                conn=conn, instance_ids=instance_ids, filters=filters,
+                tags=tags)
+        return cls(instances)
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, instance_id):
+        '''
+        Return: the record of instance_id, or None.
+        '''
+        return self.by_id.get(instance_id)
+
+    def state(self, state):
+        '''
+        Return: a list of the records in state, e.g. 'running', sorted by
+        launch time.
+        '''
+        return list(self.by_state.get(state, []))
+
+    def on_instances(self, key=None, value=None):
+        '''
+        key: a tag name.  If given, only instances whose key tag is value
+        are returned.
+        value: a tag value.
+
+        Return: a list of the records of the "on" instances, sorted by
+        launch time.
+        '''
+        if key is None:
+            return list(self.on)
+        return list(self.on_by_tag.get((key, value), []))
+
+    def on_hosts(self, key=None, value=None):
+        '''
+        Return: a list of the public dns names of the "on" instances, sorted
+        by launch time.  See on_instances.
+        '''
+        return [r.public_dns_name for r in self.on_instances(key, value)]
+
+    def latest(self, key=None, value=None):
+        '''
+        Return: the record of the "on" instance with the most recent launch
+        time, or None if there is none.  See on_instances.
+        '''
+        records = self.on if key is None else \
+            self.on_by_tag.get((key, value), [])
+        return records[-1] if records else None
+
+    def launched_between(self, start=None, end=None):
+        '''
+        start: a datetime.datetime.  Defaults to the earliest launch time.
+        end: a datetime.datetime.  Defaults to the latest launch time.
+
+        Return: a list of the records launched between start and end,
+        inclusive, sorted by launch time.
+        '''
+        lo = 0 if start is None else bisect.bisect_left(self.launch_times,
+                                                        start)
+        hi = len(self.records) if end is None else \
+            bisect.bisect_right(self.launch_times, end)
+        return self.records[lo:hi]
+
+
 #################
 # OTHER FUNCTIONS
 
@@ -167,7 +867,7 @@ def make_webserver_security_group():
     # this still needs to be tested and debugged.
     raise Exception('not implemented')
     # http://docs.pythonboto.org/en/latest/security_groups.html
-    conn = boto.connect_ec2()
+    conn = connect()
     sgs = conn.get_all_security_groups()
     print 'Existing security groups'
     for sg in sgs:
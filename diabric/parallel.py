@@ -0,0 +1,213 @@
+'''
+Run diabric functions and service methods against many hosts at once.
+
+Fabric runs a task on one host after another unless it is told to run in
+parallel, and a failure on one host aborts the whole run.  map_hosts runs any
+function on many hosts using Fabric's parallel mode with a bounded pool size,
+and collects a result or an exception for every host into one report.
+
+rolling runs a function, like a service restart, across a fleet in windows
+of hosts, so that only a fraction of the fleet is out of service at once.
+
+Usage example:
+
+    nginx = diabric.Nginx()
+    report = map_hosts(nginx.conf_include, hosts, max_workers=20,
+                       args=['mysite.conf'])
+    for host, exception in report.failed().items():
+        print host, exception
+
+    report = rolling(nginx.reload, hosts, percent=10, ready=nginx.wait_ready,
+                     failure_budget=2)
+'''
+
+
+import collections
+import numbers
+import pickle
+import traceback
+
+from fabric.api import env, execute, settings
+
+from diabric import readiness
+
+
+class HostAbort(Exception):
+    '''
+    Raised instead of SystemExit when fabric.api.abort is called by a
+    function run by map_hosts, so the abort message is kept in the report.
+    '''
+    pass
+
+
+class HostResult(collections.namedtuple('HostResult',
+                                        'host result exception traceback')):
+    '''
+    The outcome of running a function on a host.
+
+    host: the host string.
+    result: the return value of the function, or None if it raised.
+    exception: the exception raised by the function, or None if it did not.
+    traceback: the formatted traceback of exception, or None.
+    '''
+    @property
+    def succeeded(self):
+        return self.exception is None
+
+
+class Report(collections.OrderedDict):
+    '''
+    An OrderedDict mapping each host string to a HostResult, in the order
+    the hosts were given.
+    '''
+
+    def results(self):
+        '''
+        Return a dict mapping each successful host to its result.
+        '''
+        return collections.OrderedDict((h, r.result) for h, r in self.items()
+                                       if r.succeeded)
+
+    def failed(self):
+        '''
+        Return a dict mapping each failed host to its exception.
+        '''
+        return collections.OrderedDict((h, r.exception) for h, r in
+                                       self.items() if not r.succeeded)
+
+    @property
+    def succeeded(self):
+        '''
+        True if the function succeeded on every host.
+        '''
+        return all(r.succeeded for r in self.values())
+
+
+def call_on_host(func, args, kws):
+    '''
+    Call func(*args, **kws) on the current host and return a HostResult
+    instead of raising an exception.
+    '''
+    try:
+        return HostResult(env.host_string, func(*args, **kws), None, None)
+    except (Exception, SystemExit) as e:
+        tb = traceback.format_exc()
+        # results are sent back from parallel processes by pickling them.
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = Exception(repr(e))
+        return HostResult(env.host_string, None, e, tb)
+
+
+def map_hosts(func, hosts, max_workers=None, args=None, kws=None):
+    '''
+    func: a function to run on each host, e.g. diabric.venv.install or
+    Nginx().reload.  It is called as func(*args, **kws) with env.host_string
+    set to each host in turn.
+    hosts: a list of host strings.
+    max_workers: the maximum number of hosts to run func on at the same time.
+    Defaults to the number of hosts.  Each host runs in its own process, via
+    Fabric's parallel mode.  If max_workers is 1, the hosts are run one
+    after another in this process.
+    args: a list of positional arguments for func.
+    kws: a dict of keyword arguments for func.
+
+    Run func on every host, even if it fails on some hosts.  A call to
+    fabric.api.abort on a host raises HostAbort, which is recorded in the
+    report like any other exception.
+
+    Return: a Report mapping each host to a HostResult.
+    '''
+    args = args or []
+    kws = kws or {}
+    report = Report()
+    if not hosts:
+        return report
+
+    parallel = max_workers != 1
+    with settings(parallel=parallel, pool_size=max_workers,
+                  abort_exception=HostAbort):
+        results = execute(call_on_host, func, args, kws, hosts=hosts)
+
+    for host in hosts:
+        if host in results:
+            report[host] = results[host]
+    return report
+
+
+def restart_and_wait(func, ready, args, kws):
+    '''
+    Call func(*args, **kws) and then ready(), on the current host.
+
+    Return: a tuple of the result of func and the result of ready.
+    '''
+    result = func(*args, **kws)
+    return result, ready() if ready else None
+
+
+def rolling(func, hosts, batch_size=None, percent=None, ready=None,
+            failure_budget=0, min_serving=None, args=None, kws=None):
+    '''
+    func: a function to run on each host, e.g. Nginx().reload or
+    Supervisord().reload_program.  It is called as func(*args, **kws).
+    hosts: a list of host strings.
+    batch_size: the number of hosts to run func on at the same time.
+    percent: if batch_size is not given, the percentage of hosts to run func
+    on at the same time.  If neither is given, hosts are done one at a time.
+    ready: an optional function, called on each host after func, which
+    returns once the host is serving again and raises an exception if it
+    is not, e.g. Nginx().wait_ready.  If ready returns a number of seconds,
+    as the wait_ready methods do, it is recorded in
+    diabric.readiness.latencies.
+    failure_budget: the number of hosts that may fail before the rollout
+    stops.  A host fails if func or ready raises an exception.
+    min_serving: the minimum number of hosts that must be serving at any
+    time.  Windows are shrunk so that the hosts in the window plus the
+    failed hosts never exceed len(hosts) - min_serving.
+
+    Run func on the hosts in windows.  The hosts in a window are run in
+    parallel (see map_hosts), and the next window starts when every host in
+    the window is ready.  If more than failure_budget hosts have failed, or
+    min_serving can no longer be kept, the rollout stops and the remaining
+    hosts are left alone.
+
+    Return: a Report mapping each host that func was run on to a HostResult
+    holding the result of func.  Hosts missing from the report were skipped.
+    Raise: ValueError if min_serving leaves no host that can be run on.
+    '''
+    args = args or []
+    kws = kws or {}
+    if batch_size:
+        size = batch_size
+    elif percent:
+        size = max(1, int(len(hosts) * percent / 100.0))
+    else:
+        size = 1
+    max_down = len(hosts) if min_serving is None else len(hosts) - min_serving
+    if hosts and max_down < 1:
+        raise ValueError('min_serving {} leaves none of {} hosts to run on.'
+                         .format(min_serving, len(hosts)))
+
+    report = Report()
+    failures = 0
+    remaining = list(hosts)
+    while remaining:
+        window_size = min(size, max_down - failures)
+        if failures > failure_budget or window_size < 1:
+            break
+
+        window, remaining = remaining[:window_size], remaining[window_size:]
+        results = map_hosts(restart_and_wait, window,
+                            args=[func, ready, args, kws])
+        for host, r in results.items():
+            if r.succeeded:
+                result, seconds = r.result
+                r = r._replace(result=result)
+                if isinstance(seconds, numbers.Number):
+                    readiness.latencies.record(host, seconds)
+            else:
+                failures += 1
+            report[host] = r
+
+    return report
@@ -0,0 +1,162 @@
+'''
+Wait for a service to become ready after it is restarted, instead of sleeping
+for a fixed time.
+
+A check is a function that returns True when a service is ready.  The probe
+functions in this module make checks that test a remote host for a listening
+port, a successful HTTP response or a successful command.  The service classes
+in diabric (Supervisord, Upstart and Nginx) have wait_ready methods built on
+wait_ready.
+
+Usage example:
+
+    supervisord.reload_program('myapp')
+    supervisord.wait_ready('myapp', probe=http_probe('http://localhost:8000/'))
+    print latencies
+'''
+
+
+import bisect
+import collections
+import math
+import time
+
+from fabric.api import env, run, sudo, settings, hide
+
+
+class NotReady(Exception):
+    '''
+    Raised when a service does not become ready before the timeout.
+    '''
+    pass
+
+
+class LatencyHistogram(object):
+    '''
+    Collect how long each host took to become ready, and summarize the
+    latencies as a histogram.  This helps choose timeouts and pacing for
+    rolling restarts.
+    '''
+
+    def __init__(self, bounds=(0.5, 1, 2, 5, 10, 30, 60, 120)):
+        '''
+        bounds: the increasing upper bounds, in seconds, of the histogram
+        buckets.  Latencies above the last bound are counted in a final
+        overflow bucket.
+        '''
+        self.bounds = list(bounds)
+        self.latencies = collections.OrderedDict()
+
+    def record(self, host, seconds):
+        self.latencies.setdefault(host, []).append(seconds)
+
+    def values(self):
+        return [s for host in self.latencies for s in self.latencies[host]]
+
+    def counts(self):
+        '''
+        Return: a list of (upper bound, count) pairs, one per bucket.  The
+        upper bound of the overflow bucket is None.
+        '''
+        counts = [0] * (len(self.bounds) + 1)
+        for seconds in self.values():
+            counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        return zip(self.bounds + [None], counts)
+
+    def percentile(self, p):
+        '''
+        p: a percentage between 0 and 100.
+        Return: the smallest latency that is greater than or equal to p
+        percent of the latencies, or None if no latencies have been recorded.
+        '''
+        values = sorted(self.values())
+        if not values:
+            return None
+        index = int(math.ceil(len(values) * p / 100.0)) - 1
+        return values[max(index, 0)]
+
+    def __str__(self):
+        lines = []
+        for bound, count in self.counts():
+            label = '<= {}s'.format(bound) if bound is not None else 'more'
+            lines.append('{:>8} {:>6} {}'.format(label, count, '#' * count))
+        return '\n'.join(lines)
+
+
+# The histogram wait_ready records latencies in by default.  Note that hosts
+# run in parallel (e.g. by diabric.parallel.map_hosts) run in other processes,
+# so record the latencies they return instead.
+latencies = LatencyHistogram()
+
+
+def wait_until(check, timeout=60, delay=0.1, max_delay=5, backoff=2):
+    '''
+    check: a function that returns True when the wait is over.
+    timeout: the maximum number of seconds to wait.
+    delay: the number of seconds to wait before checking again after the
+    first failed check.
+    max_delay: the maximum number of seconds between checks.
+    backoff: the delay is multiplied by backoff after each failed check.
+
+    Call check until it returns True, waiting longer and longer between calls.
+
+    Return: the number of seconds waited.
+    Raise: NotReady if check does not return True within timeout seconds.
+    '''
+    start = time.time()
+    while True:
+        if check():
+            return time.time() - start
+        elapsed = time.time() - start
+        if elapsed >= timeout:
+            raise NotReady('Not ready after {:.1f} seconds.'.format(elapsed))
+        time.sleep(min(delay, timeout - elapsed))
+        delay = min(delay * backoff, max_delay)
+
+
+def wait_ready(check, timeout=60, histogram=None, **kws):
+    '''
+    Like wait_until, but also record the latency for env.host_string in
+    histogram, which defaults to the module histogram `latencies`.  kws are
+    passed to wait_until.
+
+    Return: the number of seconds waited.
+    '''
+    if histogram is None:
+        histogram = latencies
+    seconds = wait_until(check, timeout=timeout, **kws)
+    histogram.record(env.host_string, seconds)
+    return seconds
+
+
+########
+# PROBES
+
+
+def command_probe(command, use_sudo=False):
+    '''
+    Return a check that is True when command succeeds on the remote host.
+    '''
+    func = sudo if use_sudo else run
+
+    def check():
+        with settings(hide('everything'), warn_only=True):
+            return func(command).succeeded
+    return check
+
+
+def port_probe(port, host='127.0.0.1'):
+    '''
+    Return a check that is True when something is listening on port of
+    host, as seen from the remote host.
+    '''
+    return command_probe('(: < /dev/tcp/{}/{}) 2>/dev/null'.format(host, port))
+
+
+def http_probe(url, timeout=5):
+    '''
+    Return a check that is True when an HTTP GET of url, made from the
+    remote host, responds with a successful status.
+    '''
+    return command_probe('curl -sf -o /dev/null --max-time {} {}'.format(
+        timeout, url))
@@ -4,19 +4,31 @@ Fabric-based functions working with python virtual environments:
 
 - creating a new virtual environment
 - remving an existing virtual environment
+- creating a populated virtual environment from a cached snapshot
+- cloning a virtual environment using hard links
 - installing requirements in a virtual environment
-- "freezing" requirements from a virtual environment
+- building a wheelhouse of requirements once, to install them on many hosts
+  without a package index
+- "freezing" requirements from a virtual environment, and reporting how
+  frozen requirements drift across many hosts
 - getting paths of executables, etc., within a virtual environment.
 '''
 
 
 
+import collections
+import hashlib
 import os
+import re
+import uuid
 
-from fabric.api import run, put, get
+from fabric.api import run, put, local, settings, hide
 from fabric.contrib.files import exists
 from fabric.tasks import Task
 
+from diabric.files import upload_dir
+from diabric.parallel import map_hosts
+
 
 def bin(venv):
     '''
@@ -39,13 +51,84 @@ def pip(venv):
     return os.path.join(venv, 'bin', 'pip')
 
 
-def remove(venv):
+def requirements_stamp(venv):
+    '''
+    return: path to the file in which install records the hash of the
+    installed requirements.
+    '''
+    return os.path.join(venv, '.requirements.sha256')
+
+
+def trash(venv):
+    '''
+    return: path to the default trash dir used by remove for venv.  It is in
+    the same dir as venv, so venv can be renamed into it.
+    '''
+    return os.path.join(os.path.dirname(venv.rstrip('/')), '.trash')
+
+
+def reclaim_command(path):
+    '''
+    return: a shell command that deletes path with the lowest cpu and io
+    priority (if ionice is available).
+    '''
+    return ('$(command -v ionice > /dev/null && echo ionice -c 3) '
+            'nice -n 19 rm -rf {}'.format(path))
+
+
+def remove(venv, background=False, trash_dir=None):
     '''
     Remove the virtual environment completely
+
+    background: if True, instantly rename venv into trash_dir and delete it in
+    a background process with low cpu and io priority, instead of waiting for
+    the deletion.  Use sweep_trash to reclaim trash left behind, e.g. after a
+    reboot interrupted the deletion.
+    trash_dir: the remote dir venv is renamed into.  It must be on the same
+    filesystem as venv, so renaming is atomic.  Defaults to trash(venv).
     '''
     if exists(venv):
         print 'cleaning', venv
-        run('rm -rf {}'.format(venv))
+        if background:
+            trash_dir = trash_dir or trash(venv)
+            path = os.path.join(trash_dir, '{}.{}'.format(
+                os.path.basename(venv.rstrip('/')), uuid.uuid4().hex))
+            # pty=False and nohup let the deletion outlive the connection.
+            run('mkdir -p {trash_dir} && mv {venv} {path} && '
+                '(nohup {reclaim} > /dev/null 2>&1 &)'.format(
+                    trash_dir=trash_dir, venv=venv, path=path,
+                    reclaim=reclaim_command(path)), pty=False)
+        else:
+            run('rm -rf {}'.format(venv))
+
+
+def sweep_trash(trash_dir):
+    '''
+    trash_dir: a remote trash dir used by remove.
+
+    Delete everything in trash_dir, with low cpu and io priority.  Raise an
+    exception if trash_dir is empty, the root dir, or a relative path.
+    '''
+    path = os.path.normpath(trash_dir or '.')
+    if not path.startswith(('/', '~/')) or path in ('/', '//'):
+        raise Exception('Refusing to sweep trash dir {!r}.  It must be an '
+                        'absolute path other than /.'.format(trash_dir))
+    # include hidden entries, e.g. from removing a venv named .venv
+    run(reclaim_command('{0}/* {0}/.[!.]*'.format(path)))
+
+
+def sweep_trash_hosts(trash_dir, hosts, max_workers=None):
+    '''
+    trash_dir: a remote trash dir used by remove.
+    hosts: a list of host strings.
+    max_workers: the maximum number of hosts to sweep at the same time.
+
+    Run sweep_trash on many hosts in parallel.
+
+    Return: a diabric.parallel.Report of the sweep on each host.
+    '''
+    return map_hosts(sweep_trash, hosts, max_workers=max_workers,
+                     args=[trash_dir])
 
 
 def create(venv, python='python', virtualenv_script=None):
@@ -80,29 +163,310 @@ def create(venv, python='python', virtualenv_script=None):
     run('{} {} --distribute {}'.format(python, script_path, venv))
 
 
-def install(venv, requirements, upgrade=False):
+def create_from_snapshot(venv, requirements, python='python',
+                         virtualenv_script=None, wheelhouse=None,
+                         cache_dir='~/.diabric/venvs'):
+    '''
+    venv: virtual environment directory to create.  venv MUST NOT already
+    exist.
+    requirements: local path of a requirements.txt file to install in venv.
+    python, virtualenv_script: see create.
+    wheelhouse: see install.
+    cache_dir: remote directory of venv snapshots.
+
+    Create a virtual environment with requirements installed, using a cached
+    snapshot if there is one, which takes seconds instead of minutes.
+
+    Snapshots are keyed by a hash of the python version and requirements.
+    If there is no snapshot for the key in cache_dir, the venv is made with
+    create and install and then packed into a snapshot tarball.  Otherwise
+    the snapshot is unpacked into venv and the absolute paths of the venv it
+    was packed from are rewritten (see relocate).
+
+    Return: 'cached' if venv was made from a snapshot, otherwise 'built'.
+    '''
+    if exists(venv):
+        raise Exception('Path already exists. Abort creation. venv={}'.format(venv))
+
+    with settings(hide('everything')):
+        version = run('{} -V 2>&1'.format(python))
+    with open(requirements) as fh:
+        key = hashlib.sha256(version + '\n' + fh.read()).hexdigest()
+    snapshot = os.path.join(cache_dir, key + '.tar.gz')
+    # the snapshot holds the path of the venv it was packed from in this file,
+    # so that concurrent builds can not mix up snapshots and paths.
+    origin = '.snapshot-origin'
+
+    if exists(snapshot):
+        with settings(hide('stdout')):
+            old_venv = run('mkdir -p {venv} && tar -xzf {snapshot} -C {venv} '
+                           '&& cat {venv}/{origin} && rm {venv}/{origin}'
+                           .format(venv=venv, snapshot=snapshot,
+                                   origin=origin))
+        relocate(venv, old_venv.splitlines()[-1])
+        return 'cached'
+
+    create(venv, python=python, virtualenv_script=virtualenv_script)
+    install(venv, requirements, wheelhouse=wheelhouse)
+    # write the tarball under a unique temporary name, so a partial snapshot
+    # is never used.
+    tmp = '{}.{}.tmp'.format(snapshot, uuid.uuid4().hex)
+    run('mkdir -p {cache_dir} && dir=$(mktemp -d) && '
+        'echo {venv} > $dir/{origin} && '
+        'tar -czf {tmp} -C {venv} . -C $dir {origin} && rm -rf $dir && '
+        'mv {tmp} {snapshot}'.format(
+            cache_dir=cache_dir, venv=venv, origin=origin, tmp=tmp,
+            snapshot=snapshot))
+    return 'built'
+
+
+def clone(src, dest):
+    '''
+    src: an existing virtual environment directory.
+    dest: virtual environment directory to create.  dest MUST NOT already
+    exist.
+
+    Copy src to dest on the remote host using hard links (like `cp -al`), and
+    rewrite the absolute paths of src in dest (see relocate).  This is much
+    faster than create and install, and uses little extra disk space.  It is
+    useful for making the venv of a new release from the venv of the previous
+    release, after which install only has to change the packages that differ.
+
+    Files are shared between src and dest until they are replaced.  Pip
+    replaces package files instead of writing into them, but some files are
+    written in place: requirements.txt and the requirements stamp (by
+    diabric), and *.pth and *.egg-link files (by pip and setuptools, e.g.
+    easy-install.pth).  Those files are copied instead, so that changing
+    dest never changes src.
+    '''
+    if exists(dest):
+        raise Exception('Path already exists. Abort clone. dest={}'.format(dest))
+
+    unshare = 'cp -p "$f" "$f.tmp" && mv "$f.tmp" "$f"'
+    paths = [os.path.join(dest, 'requirements.txt'), requirements_stamp(dest)]
+    cmds = ['cp -al {} {}'.format(src, dest)]
+    cmds += ['for f in {}; do if test -e "$f"; then {}; fi; done'.format(
+        ' '.join(paths), unshare)]
+    cmds += ["find {} -type f \\( -name '*.pth' -o -name '*.egg-link' \\) "
+             "-exec sh -c 'for f; do {}; done' sh {{}} +".format(
+                 dest, unshare)]
+    run(' && '.join(cmds))
+    relocate(dest, src)
+
+
+def relocate(venv, old_venv):
+    '''
+    venv: the path of a virtual environment that was copied from old_venv.
+    old_venv: the path the virtual environment was created at.
+
+    Rewrite the absolute paths of old_venv to venv, with one remote command,
+    in the scripts in the bin dir of venv (the shebang lines of installed
+    scripts, the activate scripts, etc.) and in the *.pth and *.egg-link
+    files that point python at editable installs, e.g. in venv/src.  This
+    does for every script in bin what diabric.files.fix_shebang does for a
+    single file.  Files are replaced, not written into, so files hard linked
+    to another venv are not changed.
+    '''
+    old_venv = old_venv.rstrip('/')
+    venv = venv.rstrip('/')
+    if old_venv == venv:
+        return
+    # sed matches old_venv literally, and only as a whole path: followed by
+    # a '/', a quote or the end of the line, so /srv/venv2 is left alone.
+    pattern = re.sub(r'([\\.*\[\]^$|])', r'\\\1', old_venv)
+    replacement = re.sub(r'([\\&|])', r'\\\1', venv)
+    run("{{ grep -lIrF -- '{old}' {bin}; "
+        "find {venv} -type f \\( -name '*.pth' -o -name '*.egg-link' \\) "
+        "-exec grep -lF -- '{old}' {{}} +; }} | "
+        "xargs -r sed -i -e 's|{pattern}\\([/\"'\\'']\\)|{new}\\1|g' "
+        "-e 's|{pattern}$|{new}|'"
+        .format(old=old_venv, pattern=pattern, new=replacement,
+                bin=bin(venv), venv=venv))
+
+
+def install(venv, requirements, upgrade=False, wheelhouse=None,
+            skip_unchanged=False):
     '''
     venv: virtual environment directory to create.
     requirements: local path of requirements.txt file to be copied to venv dir
     to the virtual environment and used to install packages.
+    wheelhouse: optional remote directory of wheels, e.g. uploaded by
+    upload_wheelhouse.  If given, packages are installed only from the
+    wheelhouse, without contacting a package index.
+    skip_unchanged: if True, skip running pip if the same requirements have
+    already been installed into venv with the same python version.  After
+    each successful install, a hash of the requirements and the python version
+    is stored in the venv.  Ignored if upgrade is True.
     Use the venv pip to install the requirements file.
+
+    Return: 'skipped' if pip was not run, otherwise 'installed'.  Use
+    diabric.parallel.map_hosts to get this for every host.
     '''
+    stamp = requirements_stamp(venv)
+    if skip_unchanged and not upgrade:
+        # get the python version and the stored hash in one command.
+        with settings(hide('everything'), warn_only=True):
+            output = run('{} -V 2>&1; cat {} 2>/dev/null'.format(
+                python(venv), stamp))
+        lines = output.splitlines()
+        with open(requirements) as fh:
+            key = hashlib.sha256(fh.read() + (lines[0] if lines else '') +
+                                 '\n').hexdigest()
+        if lines[1:2] == [key]:
+            return 'skipped'
+
     remote_path = os.path.join(venv, 'requirements.txt')
     put(requirements, remote_path)
     upgrade_opt = '--upgrade' if upgrade else ''
-    run('{pip} install {upgrade_opt} -r {requirements}'.format(
-        pip=pip(venv), upgrade_opt=upgrade_opt, requirements=remote_path))
+    index_opt = ('--no-index --find-links={}'.format(wheelhouse)
+                 if wheelhouse else '')
+    # the stamp is computed on the remote host, the same way as the key.
+    run('{pip} install {upgrade_opt} {index_opt} -r {requirements} && '
+        '{{ cat {requirements}; {python} -V 2>&1; }} | sha256sum | '
+        "cut -d ' ' -f 1 > {stamp}.tmp && mv {stamp}.tmp {stamp}".format(
+            pip=pip(venv), upgrade_opt=upgrade_opt, index_opt=index_opt,
+            requirements=remote_path, python=python(venv), stamp=stamp))
+    return 'installed'
+
+
+def build_wheelhouse(requirements, wheelhouse, pip='pip'):
+    '''
+    requirements: local path of a requirements.txt file.
+    wheelhouse: local directory in which to put the wheels.
+    pip: the local pip executable to use.  It needs the wheel package.
+
+    Build (or download) a wheel for every package in requirements, and their
+    dependencies, on the local machine.  Do this once per deploy, then use
+    upload_wheelhouse and install(wheelhouse=...) on each host, so packages
+    are downloaded and C extensions are compiled only once.  The local
+    machine should have the same platform and python version as the hosts,
+    or the compiled wheels will not be installable on them.
+    '''
+    local('{pip} wheel --wheel-dir={wheelhouse} -r {requirements}'.format(
+        pip=pip, wheelhouse=wheelhouse, requirements=requirements))
 
 
+def upload_wheelhouse(wheelhouse, remote_dir):
+    '''
+    wheelhouse: local directory of wheels, e.g. made by build_wheelhouse.
+    remote_dir: the remote directory to put the wheels in.
 
-def freeze(venv, requirements):
+    Upload the wheelhouse as one compressed archive, removing wheels in
+    remote_dir that are no longer in wheelhouse.
+    '''
+    upload_dir(wheelhouse, remote_dir, prune='*.whl')
+
+
+
+def freeze(venv, requirements=None):
     '''
     venv: virtual environment directory to freeze.
-    requirements: local path in which to save output of pip freeze.
+    requirements: optional local path in which to save output of pip freeze.
+
+    The output of pip freeze is streamed back from the remote host, without
+    writing a file on the remote host.  Anything pip writes to stderr, like
+    deprecation warnings, is left out.
+
+    Return: the output of pip freeze.
     '''
-    remote_path = os.path.join(venv, 'requirements.txt')
-    run('{} freeze > {}'.format(pip(venv), remote_path))
-    get(remote_path, requirements)
+    with settings(hide('stdout')):
+        output = run('{} freeze'.format(pip(venv)), pty=False,
+                     combine_stderr=False)
+    text = output.replace('\r\n', '\n')
+    if text and not text.endswith('\n'):
+        text += '\n'
+    if requirements:
+        with open(requirements, 'w') as fh:
+            fh.write(text)
+    return text
+
+
+def freeze_hosts(venv, hosts, max_workers=None):
+    '''
+    venv: virtual environment directory to freeze on every host.
+    hosts: a list of host strings.
+    max_workers: the maximum number of hosts to freeze at the same time.
+
+    Run freeze on many hosts in parallel.
+
+    Return: a diabric.parallel.Report of the pip freeze output of each host.
+    '''
+    return map_hosts(freeze, hosts, max_workers=max_workers, args=[venv])
+
+
+def parse_freeze(text):
+    '''
+    text: the output of pip freeze.
+
+    Return: a dict mapping each package name to its version.  Requirements
+    that are not pinned to a version, like editable checkouts, map to the
+    whole requirement line.
+    '''
+    packages = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if '==' in line:
+            name, version = line.split('==', 1)
+        elif '#egg=' in line:
+            name, version = line.split('#egg=', 1)[1], line
+        else:
+            name, version = line, line
+        packages[name] = version
+    return packages
+
+
+def drift_report(freezes):
+    '''
+    freezes: a dict mapping each host to its pip freeze output, e.g.
+    freeze_hosts(venv, hosts).results().
+
+    Hosts with identical output are grouped by the hash of the output, so
+    each distinct output is parsed and compared only once.  The largest group
+    is the baseline, and every other group is compared to it.
+
+    Return: a list of (hosts, differences) tuples, one per distinct output,
+    largest group first.  The first tuple is the baseline, whose differences
+    are empty.  differences is a dict mapping each package that differs from
+    the baseline to a (baseline version, version) tuple, where a version of
+    None means the package is not installed.
+    '''
+    groups = collections.OrderedDict()
+    for host, text in freezes.items():
+        digest = hashlib.sha256(text).hexdigest()
+        groups.setdefault(digest, (text, []))[1].append(host)
+    if not groups:
+        return []
+
+    ordered = sorted(groups.values(), key=lambda g: -len(g[1]))
+    baseline = parse_freeze(ordered[0][0])
+    report = [(ordered[0][1], {})]
+    for text, hosts in ordered[1:]:
+        packages = parse_freeze(text)
+        differences = {}
+        for name in set(baseline) | set(packages):
+            if baseline.get(name) != packages.get(name):
+                differences[name] = (baseline.get(name), packages.get(name))
+        report.append((hosts, differences))
+    return report
+
+
+def print_drift_report(report):
+    '''
+    report: a list returned by drift_report.
+
+    Print which hosts differ from the baseline, and on which packages.
+    '''
+    if not report:
+        return
+    hosts, differences = report[0]
+    print 'baseline: {} hosts'.format(len(hosts))
+    for hosts, differences in report[1:]:
+        print '{} hosts: {}'.format(len(hosts), ' '.join(hosts))
+        for name in sorted(differences):
+            old, new = differences[name]
+            print '    {}: {} -> {}'.format(name, old, new)
 
 
 
@@ -116,21 +480,26 @@ class CreateVenv(Task):
 
 
 class InstallVenv(Task):
-    def __init__(self, venv, requirements, upgrade=False):
+    def __init__(self, venv, requirements, upgrade=False, wheelhouse=None,
+                 skip_unchanged=False):
         self.venv = venv
         self.requirements = requirements
         self.upgrade = upgrade
+        self.wheelhouse = wheelhouse
+        self.skip_unchanged = skip_unchanged
 
     def run(self, *args, **kwargs):
-        install(self.venv, self.requirements, self.upgrade)
+        return install(self.venv, self.requirements, self.upgrade,
+                       self.wheelhouse, self.skip_unchanged)
 
 
 class RemoveVenv(Task):
-    def __init__(self, venv):
+    def __init__(self, venv, background=False):
         self.venv = venv
+        self.background = background
 
     def run(self, *args, **kwargs):
-        remove(self.venv)
+        remove(self.venv, self.background)
 
 
 class FreezeVenv(Task):
@@ -1,3 +1,265 @@
+import collections
+import contextlib
+import os
+import shutil
+import subprocess
+
+import fabric.api
+from fabric.operations import _AttributeString
+
+
+def local_command(command, *args, **kws):
+    '''
+    Run command on this machine with bash, like fabric's run and sudo run it
+    on a remote host.  Like them, stderr is combined with the output unless
+    combine_stderr is False.
+    '''
+    combine_stderr = kws.get('combine_stderr', fabric.api.env.combine_stderr)
+    process = subprocess.Popen(['bash', '-c', command],
+                               stdout=subprocess.PIPE,
+                               stderr=(subprocess.STDOUT if combine_stderr
+                                       else subprocess.PIPE))
+    output, stderr = process.communicate()
+    result = _AttributeString(output.rstrip('\n'))
+    result.stderr = (stderr or '').rstrip('\n')
+    result.return_code = process.returncode
+    result.succeeded = process.returncode == 0
+    result.failed = not result.succeeded
+    if result.failed and not (fabric.api.env.warn_only or
+                              kws.get('warn_only')):
+        fabric.api.abort('{} failed:\n{}'.format(command, output))
+    return result
+
+
+def local_put(local_path=None, remote_path=None, use_sudo=False,
+              mirror_local_mode=False, mode=None, **kws):
+    '''
+    Copy local_path, a file name or file object, to remote_path on this
+    machine, like fabric's put.
+    '''
+    if hasattr(local_path, 'read'):
+        local_path.seek(0)
+        with open(remote_path, 'wb') as fh:
+            shutil.copyfileobj(local_path, fh)
+    else:
+        shutil.copy(local_path, remote_path)
+    if mode is not None:
+        os.chmod(remote_path, mode & 07777)
+    return [remote_path]
+
+
+@contextlib.contextmanager
+def patch_fabric(*modules):
+    '''
+    Replace run, sudo, put, local and exists in modules with versions that
+    work on this machine, so that functions which use a remote host can be
+    tested without one.  Yield a list to which every command and put is
+    appended.
+    '''
+    commands = []
+
+    def command(cmd, *args, **kws):
+        commands.append(cmd)
+        return local_command(cmd, *args, **kws)
+
+    def put(local_path=None, remote_path=None, *args, **kws):
+        commands.append('put {}'.format(remote_path))
+        return local_put(local_path, remote_path, *args, **kws)
+
+    def exists(path, use_sudo=False, verbose=False):
+        return os.path.exists(os.path.expanduser(path))
+
+    patches = [('run', command), ('sudo', command), ('local', command),
+               ('put', put), ('exists', exists)]
+    saved = []
+    for module in modules:
+        for name, func in patches:
+            if hasattr(module, name):
+                saved.append((module, name, getattr(module, name)))
+                setattr(module, name, func)
+    try:
+        yield commands
+    finally:
+        for module, name, func in saved:
+            setattr(module, name, func)
+
+
+class FakeClock(object):
+    '''
+    A stand-in for the time module, so that code which sleeps can be tested
+    without any time passing for real.  Every sleep is recorded in sleeps.
+    '''
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeRegion(object):
+    '''
+    A stand-in for boto.regioninfo.RegionInfo.
+    '''
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeInstance(object):
+    '''
+    A stand-in for boto.ec2.instance.Instance.
+    '''
+    def __init__(self, id, state='running',
+                 launch_time='2013-01-01T00:00:00.000Z', tags=None,
+                 region=None):
+        self.id = id
+        self.state = state
+        self.launch_time = launch_time
+        self.public_dns_name = id + '.example.com'
+        self.tags = tags or {}
+        self.region = region
+
+
+class FakeReservation(object):
+    '''
+    A stand-in for boto.ec2.instance.Reservation.
+    '''
+    def __init__(self, instances):
+        self.instances = instances
+
+
+def ec2_error(code, status=400):
+    '''
+    Return a boto EC2ResponseError with the error code code.
+    '''
+    from boto.exception import EC2ResponseError
+    e = EC2ResponseError(status, 'Error')
+    e.error_code = code
+    return e
+
+
+class FakeEC2Connection(object):
+    '''
+    A stand-in for boto.ec2.connection.EC2Connection, holding instances in
+    memory.  Every request is recorded in calls as a (method name,
+    instance ids, filters) tuple.  Terminated instances are 'shutting-down'
+    until they have been described once, then 'terminated'.
+    '''
+    def __init__(self, instances=(), region=None):
+        self.instances = collections.OrderedDict((i.id, i) for i in instances)
+        self.region = FakeRegion(region) if region else None
+        self.calls = []
+        self.seen = set()
+
+    def get_all_instances(self, instance_ids=None, filters=None):
+        self.calls.append(('get_all_instances', instance_ids, filters))
+        instances = ([self.instances[i] for i in instance_ids]
+                     if instance_ids else list(self.instances.values()))
+        for i in instances:
+            if i.state == 'shutting-down' and i.id in self.seen:
+                i.state = 'terminated'
+            self.seen.add(i.id)
+        return [FakeReservation([FakeInstance(i.id, i.state, i.launch_time,
+                                              i.tags, i.region)
+                                 for i in instances])]
+
+    def terminate_instances(self, instance_ids):
+        self.calls.append(('terminate_instances', instance_ids, None))
+        if any(i not in self.instances for i in instance_ids):
+            raise ec2_error('InvalidInstanceID.NotFound')
+        for i in instance_ids:
+            self.instances[i].state = 'shutting-down'
+            self.seen.discard(i)
+        return [FakeInstance(i, 'shutting-down') for i in instance_ids]
+
+
+
+@contextlib.contextmanager
+def fake_commands(scripts):
+    '''
+    scripts: a dict mapping command names to the contents of shell scripts.
+
+    Put the scripts first on the PATH, to stand in for commands like nginx
+    that are not installed on this machine.
+    '''
+    import tempfile
+
+    bin_dir = tempfile.mkdtemp()
+    for name, script in scripts.items():
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as fh:
+            fh.write('#!/bin/sh\n' + script)
+        os.chmod(path, 0755)
+    path = os.environ['PATH']
+    os.environ['PATH'] = bin_dir + os.pathsep + path
+    try:
+        yield bin_dir
+    finally:
+        os.environ['PATH'] = path
+        shutil.rmtree(bin_dir)
+
+
+@contextlib.contextmanager
+def local_supervisord(programs):
+    '''
+    Start a supervisord on this machine, with a program running `sleep` for
+    each name in programs.  Yield a diabric.Supervisord that controls it,
+    with diabric patched by patch_fabric, and the list of commands run.
+    '''
+    import diabric
+    import sys
+    import tempfile
+    from diabric.readiness import wait_until
+
+    dirname = tempfile.mkdtemp()
+    conf_file = os.path.join(dirname, 'supervisord.conf')
+    include_dir = os.path.join(dirname, 'conf.d')
+    bin_dir = os.path.join(dirname, 'bin')
+    sock = os.path.join(dirname, 'sock')
+    os.mkdir(include_dir)
+    os.mkdir(bin_dir)
+    with open(conf_file, 'w') as fh:
+        fh.write('[unix_http_server]\nfile={sock}\n'
+                 '[supervisord]\nlogfile={dir}/log\npidfile={dir}/pid\n'
+                 '[rpcinterface:supervisor]\nsupervisor.rpcinterface_factory'
+                 ' = supervisor.rpcinterface:make_main_rpcinterface\n'
+                 '[supervisorctl]\nserverurl=unix://{sock}\n'
+                 '[include]\nfiles={dir}/conf.d/*.conf\n'.format(
+                     dir=dirname, sock=sock))
+    for program in programs:
+        with open(os.path.join(include_dir, program + '.conf'), 'w') as fh:
+            fh.write('[program:{}]\ncommand=sleep 1000\nstartsecs=0\n'.format(
+                program))
+    # supervisorctl, as run by Supervisord, finds this supervisord.
+    supervisorctl = os.path.join(bin_dir, 'supervisorctl')
+    with open(supervisorctl, 'w') as fh:
+        fh.write('#!/bin/sh\nexec {} -m supervisor.supervisorctl -c {} "$@"\n'
+                 .format(sys.executable, conf_file))
+    os.chmod(supervisorctl, 0755)
+
+    path = os.environ['PATH']
+    os.environ['PATH'] = bin_dir + os.pathsep + path
+    process = subprocess.Popen([sys.executable, '-m', 'supervisor.supervisord',
+                                '-n', '-c', conf_file])
+    supervisord = diabric.Supervisord(conf_file, include_dir,
+                                      serverurl='unix://' + sock,
+                                      python=sys.executable)
+    try:
+        with patch_fabric(diabric) as commands:
+            wait_until(lambda: all(supervisord.is_running(p)
+                                   for p in programs),
+                       timeout=30, max_delay=0.2)
+            del commands[:]
+            yield supervisord, commands
+    finally:
+        os.environ['PATH'] = path
+        process.terminate()
+        process.wait()
+        shutil.rmtree(dirname)
 
 
 def test_config():
@@ -75,4 +337,1121 @@ there
     assert result == outdata
 
 
+def test_upload_many():
+    '''
+    Upload two files, one with a new shebang and one formatted, in one call.
+    Read the uploaded files and compare to what should have been uploaded.
+    Check that the upload took two remote commands and one put, and that
+    uploading more files does not take any more.
+    '''
+    import diabric.files
+    import tempfile
+
+    dirname = tempfile.mkdtemp()
+    script = os.path.join(dirname, 'script')
+    template = os.path.join(dirname, 'template')
+    with open(script, 'w') as fh:
+        fh.write('#!/user/bin/foo\nhi\n')
+    with open(template, 'w') as fh:
+        fh.write('hi {name}\n')
+
+    with patch_fabric(diabric.files) as commands:
+        dests = diabric.files.upload_many([
+            {'filename': script, 'destination': dirname + '/script2',
+             'shebang': '#!/usr/bin/env python'},
+            {'filename': template, 'destination': dirname + '/template2',
+             'kws': {'name': 'there'}},
+        ])
+        results = [open(dest).read() for dest in dests]
+        assert results == ['#!/usr/bin/env python\nhi\n', 'hi there\n']
+        assert [c.split()[0] for c in commands] == ['if', 'put', 'mkdir']
+
+        del commands[:]
+        specs = [{'filename': template,
+                  'destination': os.path.join(dirname, 'many{}'.format(i)),
+                  'kws': {'name': i}} for i in range(20)]
+        dests = diabric.files.upload_many(specs)
+        assert len(dests) == 20 and open(dests[-1]).read() == 'hi 19\n'
+        assert [c.split()[0] for c in commands] == ['if', 'put', 'mkdir']
+
+
+def test_upload_skip_unchanged():
+    '''
+    Upload files with upload_shebang, upload_format and the conf uploads of
+    Upstart, Supervisord and Nginx, twice each with skip_unchanged.  Check
+    that the second, identical, upload returns False without a put or a
+    backup, and that a changed file is uploaded again.
+    '''
+    import diabric
+    import diabric.files
+    import tempfile
+
+    local_dir = tempfile.mkdtemp()
+    remote_dir = tempfile.mkdtemp()
+    filename = os.path.join(local_dir, 'app.conf')
+    with open(filename, 'w') as fh:
+        fh.write('#!/bin/foo\nhi {name}\n')
+
+    uploads = [
+        lambda: diabric.files.upload_shebang(
+            filename, remote_dir + '/shebang', '#!/bin/sh',
+            skip_unchanged=True),
+        lambda: diabric.files.upload_format(
+            filename, remote_dir + '/format', kws={'name': 'there'},
+            skip_unchanged=True),
+        lambda: diabric.Upstart(remote_dir).conf_program(
+            filename, dest_name='upstart', skip_unchanged=True),
+        lambda: diabric.Supervisord(include_dir=remote_dir).conf_include(
+            filename, dest_name='supervisord', skip_unchanged=True),
+        lambda: diabric.Nginx(remote_dir).conf_include(
+            filename, dest_name='nginx', skip_unchanged=True),
+    ]
+    names = ['format', 'nginx', 'shebang', 'supervisord', 'upstart']
+    with patch_fabric(diabric, diabric.files) as commands:
+        assert [upload() for upload in uploads] == [True] * 5
+        assert sorted(os.listdir(remote_dir)) == names
+        with open(os.path.join(remote_dir, 'format')) as fh:
+            assert fh.read() == '#!/bin/foo\nhi there\n'
+
+        del commands[:]
+        assert [upload() for upload in uploads] == [False] * 5
+        assert not [c for c in commands if c.startswith('put ')]
+        assert sorted(os.listdir(remote_dir)) == names
+
+        with open(filename, 'a') as fh:
+            fh.write('bye\n')
+        assert [upload() for upload in uploads] == [True] * 5
+        with open(os.path.join(remote_dir, 'shebang.bak')) as fh:
+            assert fh.read() == '#!/bin/sh\nhi {name}\n'
+
+
+def test_map_hosts():
+    '''
+    Run a function that does not connect to any host on several hosts,
+    in parallel and serially.  Check that results and exceptions are
+    collected for every host.
+    '''
+    import diabric.parallel
+    import fabric.api
+
+    def func(x, y=0):
+        if fabric.api.env.host_string == 'b':
+            fabric.api.abort('b failed')
+        return fabric.api.env.host_string + str(x + y)
+
+    for max_workers in [None, 1]:
+        report = diabric.parallel.map_hosts(func, ['a', 'b', 'c'],
+                                            max_workers=max_workers,
+                                            args=[1], kws={'y': 2})
+        assert report.keys() == ['a', 'b', 'c']
+        assert report.results() == {'a': 'a3', 'c': 'c3'}
+        assert str(report.failed()['b']) == 'b failed'
+        assert not report.succeeded
+
+
+def test_template_cache():
+    '''
+    Test that a cached template is reused until it is modified, that the
+    least recently used template is evicted, that a cache with maxsize 0
+    caches nothing, and that file_format uses the cache.
+    '''
+    import diabric.files
+    import tempfile
+    import os
+
+    dirname = tempfile.mkdtemp()
+    names = [os.path.join(dirname, n) for n in ['a', 'b', 'c']]
+    for name in names:
+        with open(name, 'w') as fh:
+            fh.write('hi {}\n')
+
+    cache = diabric.files.TemplateCache(maxsize=2)
+    assert cache.text(names[0]) == 'hi {}\n'
+    with open(names[0], 'w') as fh:
+        fh.write('hello {}!\n')
+    assert cache.text(names[0]) == 'hello {}!\n'
+
+    for name in names:
+        cache.text(name)
+    assert len(cache.templates) == 2
+    assert [key[1] for key in cache.templates] == names[1:]
+
+    cache = diabric.files.TemplateCache(maxsize=0)
+    assert cache.text(names[1]) == 'hi {}\n'
+    assert len(cache.templates) == 0
+
+    outfile = os.path.join(dirname, 'out')
+    diabric.files.file_format(names[0], outfile, args=['there'])
+    with open(outfile) as fh:
+        assert fh.read() == 'hello there!\n'
+
+
+def test_stream_file():
+    '''
+    Test that a StreamFile reads the lines of a formatted file in chunks,
+    the same as formatting the whole file, and can be rewound.
+    '''
+    import diabric.files
+    import tempfile
+    import os
+
+    fd, name = tempfile.mkstemp()
+    try:
+        with open(name, 'w') as fh:
+            fh.write(''.join('line {0} {{x}}\n'.format(i) for i in range(1000)))
+        with open(name) as fh:
+            expected = fh.read().format(x='hi')
+
+        stream = diabric.files.StreamFile(
+            lambda: diabric.files.format_lines(name, kws={'x': 'hi'}))
+        chunks = list(iter(lambda: stream.read(100), ''))
+        assert set(len(chunk) for chunk in chunks[:-1]) == set([100])
+        assert ''.join(chunks) == expected
+        assert stream.tell() == len(expected)
+        stream.seek(0)
+        assert stream.read() == expected
+    finally:
+        os.unlink(name)
+
+
+def test_upload_stream():
+    '''
+    Upload a large file with upload_shebang and upload_format, streaming it,
+    with and without skip_unchanged.  Check that the uploads match the
+    uploads that are not streamed, that the stream is put from its start
+    after being digested, and that an unchanged stream is skipped.
+    '''
+    import diabric.files
+    import tempfile
+
+    local_dir = tempfile.mkdtemp()
+    remote_dir = tempfile.mkdtemp()
+    filename = os.path.join(local_dir, 'big')
+    with open(filename, 'w') as fh:
+        fh.write('#!/bin/foo\n')
+        fh.write(''.join('line {0} {{x}}\n'.format(i) for i in range(10000)))
+
+    def upload(name, stream, skip_unchanged=False):
+        dest = os.path.join(remote_dir, name)
+        if name.startswith('shebang'):
+            return diabric.files.upload_shebang(
+                filename, dest, '#!/bin/sh', stream=stream,
+                skip_unchanged=skip_unchanged)
+        else:
+            return diabric.files.upload_format(
+                filename, dest, kws={'x': 'hi'}, stream=stream,
+                skip_unchanged=skip_unchanged)
+
+    positions = []
+    with patch_fabric(diabric.files):
+        patched_put = diabric.files.put
+
+        def put(local_path=None, *args, **kws):
+            # like fabric's put, restore the position of a file object.
+            position = local_path.tell()
+            positions.append(position)
+            result = patched_put(local_path, *args, **kws)
+            local_path.seek(position)
+            return result
+
+        diabric.files.put = put
+        for name in ['shebang', 'format']:
+            assert upload(name, stream=False)
+            assert upload(name + '-stream', stream=True)
+            assert upload(name + '-skip', stream=True, skip_unchanged=True)
+            assert not upload(name + '-skip', stream=True,
+                              skip_unchanged=True)
+            texts = []
+            for suffix in ['', '-stream', '-skip']:
+                with open(os.path.join(remote_dir, name + suffix)) as fh:
+                    texts.append(fh.read())
+            assert texts[1] == texts[2] == texts[0]
+    assert positions == [0] * 6
+    with open(os.path.join(remote_dir, 'format')) as fh:
+        assert fh.read().splitlines()[:2] == ['#!/bin/foo', 'line 0 hi']
+
+
+def test_upload_dir():
+    '''
+    Upload a directory with a mode override over a remote dir with stale
+    files.  Check that prune with a pattern only removes matching files,
+    and that prune=True removes every file missing from the local dir.
+    '''
+    import diabric.files
+    import stat
+    import tempfile
+
+    local_dir = tempfile.mkdtemp()
+    remote_dir = tempfile.mkdtemp()
+    os.mkdir(os.path.join(local_dir, 'sub'))
+    for name in ['a.conf', 'sub/b.conf']:
+        with open(os.path.join(local_dir, name), 'w') as fh:
+            fh.write(name + '\n')
+    for name in ['stale.conf', 'keep.txt']:
+        with open(os.path.join(remote_dir, name), 'w') as fh:
+            fh.write('old\n')
+
+    with patch_fabric(diabric.files) as commands:
+        names = diabric.files.upload_dir(local_dir, remote_dir, mode=0600,
+                                         prune='*.conf')
+    assert names == ['a.conf', 'sub/b.conf']
+    assert len([c for c in commands if not c.startswith('put ')]) == 1
+    assert sorted(os.listdir(remote_dir)) == ['a.conf', 'keep.txt', 'sub']
+    with open(os.path.join(remote_dir, 'sub/b.conf')) as fh:
+        assert fh.read() == 'sub/b.conf\n'
+    mode = stat.S_IMODE(os.stat(os.path.join(remote_dir, 'a.conf')).st_mode)
+    assert mode == 0600
+
+    with patch_fabric(diabric.files):
+        diabric.files.upload_dir(local_dir, remote_dir, prune=True)
+    assert sorted(os.listdir(remote_dir)) == ['a.conf', 'sub']
+    mode = stat.S_IMODE(os.stat(os.path.join(remote_dir, 'a.conf')).st_mode)
+    assert mode == stat.S_IMODE(os.stat(os.path.join(local_dir,
+                                                     'a.conf')).st_mode)
+
+
+def test_fix_group_perms():
+    '''
+    Make a tree with a dir missing setgid and a file missing group write
+    permissions.  Fix it locally, then break the file and fix it
+    incrementally, which should not recheck the dir.
+    '''
+    import diabric
+    import grp
+    import os
+    import stat
+    import tempfile
+
+    dirname = tempfile.mkdtemp()
+    subdir = os.path.join(dirname, 'sub')
+    filename = os.path.join(subdir, 'file')
+    stamp = os.path.join(dirname, 'stamp')
+    os.mkdir(subdir, 0755)
+    with open(filename, 'w') as fh:
+        fh.write('hi\n')
+    os.chmod(filename, 0644)
+    group = grp.getgrgid(os.getgid()).gr_name
+
+    counts = diabric.fix_group_perms(subdir, group=group, remote=False,
+                                     stamp=stamp)
+    assert counts == {'setgid': 1, 'group_write': 2}
+    assert os.stat(subdir).st_mode & stat.S_ISGID
+    assert os.stat(filename).st_mode & stat.S_IWGRP
+    assert os.path.exists(stamp)
+
+    os.chmod(filename, 0644)
+    counts = diabric.fix_group_perms(subdir, group=group, remote=False,
+                                     stamp=stamp)
+    assert counts == {'group_write': 1}
+    assert os.stat(filename).st_mode & stat.S_IWGRP
+
+
+def test_supervisord_multicall():
+    '''
+    Reload a program of a local supervisord with one multicall, and check
+    that it was restarted with one command.  Check that reloading a missing
+    program raises an exception for the faults.
+    '''
+    import diabric
+
+    with local_supervisord(['app']) as (supervisord, commands):
+        def pid():
+            calls = [('supervisor.getProcessInfo', ['app'])]
+            return supervisord.multicall(calls)[0]['pid']
+
+        old_pid = pid()
+        del commands[:]
+        supervisord.reload_program('app', rpc=True)
+        assert len(commands) == 1
+        assert pid() not in (0, old_pid)
+        assert supervisord.is_running('app')
+
+        try:
+            supervisord.reload_program('missing', rpc=True)
+        except Exception as e:
+            assert e.args[0] == 'Supervisord call failed.'
+            assert e.args[1][0]['faultString'].startswith('BAD_NAME')
+        else:
+            assert False
+
+
+def test_supervisord_reload_programs():
+    '''
+    Reload programs of a local supervisord, all of them and only the changed
+    or added ones.  Check that each reload, including finding the changed
+    programs, is one command and that only the reloaded programs were
+    restarted.
+    '''
+    import diabric
+
+    with local_supervisord(['a', 'b']) as (supervisord, commands):
+        def pid(program):
+            calls = [('supervisor.getProcessInfo', [program])]
+            return supervisord.multicall(calls)[0]['pid']
+
+        pids = dict((p, pid(p)) for p in ['a', 'b'])
+        del commands[:]
+        assert supervisord.reload_programs(['a', 'b']) == ['a', 'b']
+        assert len(commands) == 1
+        assert all(pid(p) != pids[p] for p in ['a', 'b'])
+
+        pids = dict((p, pid(p)) for p in ['a', 'b'])
+        del commands[:]
+        assert supervisord.reload_programs(['a', 'b'],
+                                           changed_only=True) == []
+        assert len(commands) == 1
+        with open(os.path.join(supervisord.include_dir, 'b.conf'), 'a') as fh:
+            fh.write('startretries=4\n')
+        with open(os.path.join(supervisord.include_dir, 'c.conf'), 'w') as fh:
+            fh.write('[program:c]\ncommand=sleep 1000\nstartsecs=0\n')
+        del commands[:]
+        assert supervisord.reload_programs(['a', 'b', 'c'],
+                                           changed_only=True) == ['b', 'c']
+        assert len(commands) == 1
+        assert pid('a') == pids['a'] and pid('b') != pids['b']
+        supervisord.wait_ready('c', timeout=10)
+
+
+def test_nginx_apply():
+    '''
+    Apply nginx includes, then apply a broken include and a new include.
+    Check that the failed `nginx -t` restores the include dir exactly,
+    including when a stale backup of the new include exists, and that nginx
+    is only reloaded after a successful test.
+    '''
+    import diabric
+    import diabric.files
+    import tempfile
+
+    local_dir = tempfile.mkdtemp()
+    include_dir = tempfile.mkdtemp()
+    reloads = os.path.join(local_dir, 'reloads')
+
+    def write(name, text):
+        with open(os.path.join(local_dir, name), 'w') as fh:
+            fh.write(text)
+
+    def listing():
+        return dict((name, open(os.path.join(include_dir, name)).read())
+                    for name in os.listdir(include_dir))
+
+    write('a.conf', 'server a;\n')
+    write('b.conf', 'server b;\n')
+    nginx = diabric.Nginx(include_dir)
+    scripts = {'nginx': '! grep -rq broken {}\n'.format(include_dir),
+               'service': 'echo "$@" >> {}\n'.format(reloads)}
+    with fake_commands(scripts), patch_fabric(diabric, diabric.files):
+        changed = nginx.apply([os.path.join(local_dir, n)
+                               for n in ['a.conf', 'b.conf']])
+        assert sorted(changed) == [os.path.join(include_dir, n)
+                                   for n in ['a.conf', 'b.conf']]
+        before = listing()
+        assert before == {'a.conf': 'server a;\n', 'b.conf': 'server b;\n'}
+
+        write('a.conf', 'broken;\n')
+        write('c.conf', 'server c;\n')
+        with open(os.path.join(include_dir, 'c.conf.bak'), 'w') as fh:
+            fh.write('stale\n')
+        try:
+            nginx.apply([os.path.join(local_dir, n)
+                         for n in ['a.conf', 'b.conf', 'c.conf']])
+        except Exception as e:
+            assert e.args[0].startswith('Nginx configuration test failed.')
+            assert sorted(e.args[1]) == [os.path.join(include_dir, n)
+                                         for n in ['a.conf', 'c.conf']]
+        else:
+            assert False
+        assert listing() == before
+
+    with open(reloads) as fh:
+        assert fh.read() == 'nginx reload\n'
+
+
+def test_upstart_apply():
+    '''
+    Apply upstart configurations, one of which fails to start.  Check that
+    the files are installed and the programs restarted with one remote
+    command after the upload, that every program is restarted despite the
+    failure, and that the failure is reported for its program only.
+    '''
+    import diabric
+    import diabric.files
+    import tempfile
+
+    local_dir = tempfile.mkdtemp()
+    conf_dir = tempfile.mkdtemp()
+    log = os.path.join(local_dir, 'log')
+    names = ['good', 'bad', 'other']
+    for name in names:
+        with open(os.path.join(local_dir, name + '.conf'), 'w') as fh:
+            fh.write('exec {}\n'.format(name))
+    conf_files = [os.path.join(local_dir, n + '.conf') for n in names]
+
+    upstart = diabric.Upstart(conf_dir)
+    script = 'echo "$@" >> {}\ntest "$*" != "start bad"\n'.format(log)
+    with fake_commands({'initctl': script}):
+        with patch_fabric(diabric, diabric.files) as commands:
+            try:
+                upstart.apply(conf_files)
+            except Exception as e:
+                assert e.args[1:] == (['bad'], ['good', 'other'])
+            else:
+                assert False
+            assert [c.split()[0] for c in commands] == ['if', 'put', 'mkdir']
+            assert sorted(os.listdir(conf_dir)) == [n + '.conf'
+                                                    for n in sorted(names)]
+
+            del commands[:]
+            assert upstart.apply(conf_files) == []
+            assert len(commands) == 1
+
+    with open(log) as fh:
+        assert fh.read().splitlines() == [
+            'reload-configuration', 'stop good', 'start good', 'stop bad',
+            'start bad', 'stop other', 'start other']
+
+
+def test_venv_install():
+    '''
+    Install requirements into a fake venv.  Check that a plain install does
+    not query the venv first, that the stamp written on the "remote" host
+    lets skip_unchanged skip pip, and that changed requirements are
+    installed.
+    '''
+    import diabric.venv
+    import tempfile
+
+    venv = tempfile.mkdtemp()
+    requirements = os.path.join(tempfile.mkdtemp(), 'requirements.txt')
+    os.mkdir(os.path.join(venv, 'bin'))
+    for name, script in [('python', 'echo Python 2.7.18\n'),
+                         ('pip', 'echo "$@" >> {}/pip.log\n'.format(venv))]:
+        path = os.path.join(venv, 'bin', name)
+        with open(path, 'w') as fh:
+            fh.write('#!/bin/sh\n' + script)
+        os.chmod(path, 0755)
+    with open(requirements, 'w') as fh:
+        fh.write('Django==1.4.2\n')
+
+    with patch_fabric(diabric.venv) as commands:
+        assert diabric.venv.install(venv, requirements) == 'installed'
+        assert [c.split()[0] for c in commands] == [
+            'put', diabric.venv.pip(venv)]
+
+        del commands[:]
+        assert diabric.venv.install(venv, requirements,
+                                    skip_unchanged=True) == 'skipped'
+        assert len(commands) == 1
+
+        with open(requirements, 'a') as fh:
+            fh.write('boto==2.9.0\n')
+        assert diabric.venv.install(venv, requirements,
+                                    skip_unchanged=True) == 'installed'
+        assert diabric.venv.install(venv, requirements,
+                                    skip_unchanged=True) == 'skipped'
+
+    with open(os.path.join(venv, 'pip.log')) as fh:
+        assert len(fh.read().splitlines()) == 2
+
+
+def test_venv_wheelhouse():
+    '''
+    Build a wheelhouse with a fake pip, upload it over a remote dir with a
+    stale wheel, and install from it.  Check that only stale wheels are
+    pruned and that pip installs from the wheelhouse without an index.
+    '''
+    import diabric.files
+    import diabric.venv
+    import tempfile
+
+    root = tempfile.mkdtemp()
+    wheelhouse = os.path.join(root, 'wheelhouse')
+    remote_dir = os.path.join(root, 'remote')
+    venv = os.path.join(root, 'venv')
+    requirements = os.path.join(root, 'requirements.txt')
+    with open(requirements, 'w') as fh:
+        fh.write('Django==1.4.2\n')
+    os.mkdir(remote_dir)
+    for name in ['Django-1.4.1-py2-none-any.whl', 'README']:
+        with open(os.path.join(remote_dir, name), 'w') as fh:
+            fh.write('old\n')
+    os.makedirs(os.path.join(venv, 'bin'))
+    for name, script in [('python', 'echo Python 2.7.18\n'),
+                         ('pip', 'echo "$@" >> {}/pip.log\n'.format(venv))]:
+        path = os.path.join(venv, 'bin', name)
+        with open(path, 'w') as fh:
+            fh.write('#!/bin/sh\n' + script)
+        os.chmod(path, 0755)
+
+    # a pip that "builds" one wheel into the --wheel-dir.
+    pip = ('echo "$@" > {}/pip.log\n'
+           'mkdir -p "${{2#--wheel-dir=}}"\n'
+           'touch "${{2#--wheel-dir=}}/Django-1.4.2-py2-none-any.whl"\n'
+           ).format(root)
+    with fake_commands({'pip': pip}):
+        with patch_fabric(diabric.venv, diabric.files) as commands:
+            diabric.venv.build_wheelhouse(requirements, wheelhouse)
+            diabric.venv.upload_wheelhouse(wheelhouse, remote_dir)
+            assert len([c for c in commands if not c.startswith('put ')]) == 2
+            diabric.venv.install(venv, requirements, wheelhouse=remote_dir)
+
+    with open(os.path.join(root, 'pip.log')) as fh:
+        assert fh.read() == 'wheel --wheel-dir={} -r {}\n'.format(
+            wheelhouse, requirements)
+    assert sorted(os.listdir(remote_dir)) == [
+        'Django-1.4.2-py2-none-any.whl', 'README']
+    with open(os.path.join(venv, 'pip.log')) as fh:
+        args = fh.read().split()
+    assert args[0] == 'install' and '--upgrade' not in args
+    assert args[1:3] == ['--no-index', '--find-links=' + remote_dir]
+
+
+def test_venv_create_from_snapshot():
+    '''
+    Build a fake venv, which packs a snapshot, then create another venv
+    from the snapshot.  Check that the paths of the first venv are rewritten
+    to the second, and that the origin path stored in the snapshot is not
+    left in the new venv.
+    '''
+    import diabric.venv
+    import sys
+    import tempfile
+
+    root = tempfile.mkdtemp()
+    cache_dir = os.path.join(root, 'cache')
+    requirements = os.path.join(root, 'requirements.txt')
+    with open(requirements, 'w') as fh:
+        fh.write('Django==1.4.2\n')
+
+    def create(venv, python=None, virtualenv_script=None):
+        os.makedirs(os.path.join(venv, 'bin'))
+        with open(os.path.join(venv, 'bin', 'activate'), 'w') as fh:
+            fh.write('VIRTUAL_ENV="{}"\n'.format(venv))
+
+    def install(venv, requirements, wheelhouse=None):
+        pass
+
+    old_create, old_install = diabric.venv.create, diabric.venv.install
+    diabric.venv.create, diabric.venv.install = create, install
+    try:
+        with patch_fabric(diabric.venv):
+            venvs = [os.path.join(root, name) for name in ['a', 'b']]
+            for venv, how in zip(venvs, ['built', 'cached']):
+                assert diabric.venv.create_from_snapshot(
+                    venv, requirements, python=sys.executable,
+                    cache_dir=cache_dir) == how
+    finally:
+        diabric.venv.create, diabric.venv.install = old_create, old_install
+
+    assert len(os.listdir(cache_dir)) == 1
+    for venv in venvs:
+        with open(os.path.join(venv, 'bin', 'activate')) as fh:
+            assert fh.read() == 'VIRTUAL_ENV="{}"\n'.format(venv)
+        assert sorted(os.listdir(venv)) == ['bin']
+
+
+def test_venv_clone():
+    '''
+    Clone a fake venv with an editable install.  Check that package files
+    stay hard linked, that files written in place (requirements.txt, .pth
+    and .egg-link files) are copied, and that the paths in them and in bin
+    are rewritten in the clone only.
+    '''
+    import diabric.venv
+    import tempfile
+
+    root = tempfile.mkdtemp()
+    src = os.path.join(root, 'release1')
+    dest = os.path.join(root, 'release2')
+    site = os.path.join('lib', 'python2.7', 'site-packages')
+    files = {
+        'bin/activate': 'VIRTUAL_ENV="{}"\n',
+        'requirements.txt': '-e mypkg\n',
+        site + '/easy-install.pth': '{}/src/mypkg\n',
+        site + '/mypkg.egg-link': '{}/src/mypkg\n.',
+        site + '/django.py': 'pass\n',
+    }
+    for name, text in files.items():
+        path = os.path.join(src, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            fh.write(text.replace('{}', src))
+
+    with patch_fabric(diabric.venv):
+        diabric.venv.clone(src, dest)
+
+    for name, text in files.items():
+        for venv in [src, dest]:
+            with open(os.path.join(venv, name)) as fh:
+                assert fh.read() == text.replace('{}', venv)
+        linked = (os.stat(os.path.join(src, name)).st_ino ==
+                  os.stat(os.path.join(dest, name)).st_ino)
+        assert linked == name.endswith('django.py')
+
+
+def test_venv_relocate():
+    '''
+    Relocate a venv whose old path has a '.' in it.  Check that the old path
+    is rewritten before a '/', a quote or the end of a line, and that paths
+    which only match it as a regex or as a prefix are left alone.
+    '''
+    import diabric.venv
+    import tempfile
+
+    root = tempfile.mkdtemp()
+    old = os.path.join(root, 'app.v1')
+    venv = os.path.join(root, 'app-v2')
+    lines = ['#!{}/bin/python', 'VIRTUAL_ENV="{}"', "VIRTUAL_ENV='{}'", '{}']
+    others = [old + '2/bin/python', old.replace('.', 'x') + '/bin/python']
+    names = ['bin/activate', 'lib/python2.7/site-packages/easy-install.pth']
+    for name in names:
+        os.makedirs(os.path.dirname(os.path.join(venv, name)))
+        with open(os.path.join(venv, name), 'w') as fh:
+            fh.write(''.join(l.format(old) + '\n' for l in lines + others))
+
+    with patch_fabric(diabric.venv):
+        diabric.venv.relocate(venv, old + '/')
+
+    for name in names:
+        with open(os.path.join(venv, name)) as fh:
+            assert fh.read().splitlines() == [l.format(venv) for l in lines
+                                              ] + others
+
+
+def test_venv_remove_background():
+    '''
+    Remove a venv in the background and sweep a trash dir, including hidden
+    entries.  Check that sweep_trash refuses an empty, root or relative trash
+    dir without running any command.
+    '''
+    import diabric.venv
+    import tempfile
+    import time
+
+    root = tempfile.mkdtemp()
+    venv = os.path.join(root, 'venv')
+    os.makedirs(os.path.join(venv, 'bin'))
+    with patch_fabric(diabric.venv):
+        diabric.venv.remove(venv, background=True)
+        assert not os.path.exists(venv)
+        trash_dir = diabric.venv.trash(venv)
+        for i in range(100):
+            if not os.listdir(trash_dir):
+                break
+            time.sleep(0.05)
+        assert os.listdir(trash_dir) == []
+
+        for name in ['old', '.hidden']:
+            os.makedirs(os.path.join(trash_dir, name, 'bin'))
+        diabric.venv.sweep_trash(trash_dir + '/')
+        assert os.listdir(trash_dir) == []
+
+    commands = []
+    old_run = diabric.venv.run
+    diabric.venv.run = lambda cmd, *args, **kws: commands.append(cmd)
+    try:
+        for trash_dir in ['', None, '/', '//', '/tmp/..', 'trash', '~']:
+            try:
+                diabric.venv.sweep_trash(trash_dir)
+            except Exception as e:
+                assert e.args[0].startswith('Refusing to sweep')
+            else:
+                assert False
+        assert commands == []
+        diabric.venv.sweep_trash('~/.trash')
+        assert commands == [diabric.venv.reclaim_command(
+            '~/.trash/* ~/.trash/.[!.]*')]
+    finally:
+        diabric.venv.run = old_run
+
+
+def test_readiness():
+    '''
+    Test waiting for a check that becomes True, with backoff up to max_delay,
+    and timing out, using a fake clock.  Test summarizing latencies in a
+    histogram.
+    '''
+    import diabric.readiness
+
+    calls = []
+    def check():
+        calls.append(1)
+        return len(calls) == 3
+
+    clock = FakeClock()
+    old_time, diabric.readiness.time = diabric.readiness.time, clock
+    try:
+        seconds = diabric.readiness.wait_until(check, timeout=5, delay=1,
+                                               max_delay=2)
+        assert len(calls) == 3 and seconds == 3
+        assert clock.sleeps == [1, 2]
+        del clock.sleeps[:]
+        try:
+            diabric.readiness.wait_until(lambda: False, timeout=5, delay=1,
+                                         max_delay=2)
+            assert False
+        except diabric.readiness.NotReady:
+            pass
+        assert clock.sleeps == [1, 2, 2]
+    finally:
+        diabric.readiness.time = old_time
+
+    histogram = diabric.readiness.LatencyHistogram(bounds=[1, 10])
+    for host, seconds in [('a', 0.5), ('b', 5), ('c', 7), ('c', 100)]:
+        histogram.record(host, seconds)
+    assert histogram.counts() == [(1, 1), (10, 2), (None, 1)]
+    assert histogram.percentile(50) == 5
+    assert histogram.latencies['c'] == [7, 100]
+
+
+def test_rolling():
+    '''
+    Roll a function that does not connect to any host across hosts, two
+    at a time.  Check that the rollout stops after a window with a failure,
+    and that a min_serving of every host is refused.
+    '''
+    import diabric.parallel
+    import fabric.api
+
+    def func():
+        if fabric.api.env.host_string == 'c':
+            raise Exception('c failed')
+        return fabric.api.env.host_string
+
+    hosts = ['a', 'b', 'c', 'd', 'e', 'f']
+    report = diabric.parallel.rolling(func, hosts, batch_size=2)
+    assert report.keys() == ['a', 'b', 'c', 'd']
+    assert report.failed().keys() == ['c']
+
+    report = diabric.parallel.rolling(func, hosts, percent=50,
+                                      failure_budget=1, min_serving=4,
+                                      ready=lambda: 0.5)
+    assert report.keys() == hosts
+    assert report.results()['f'] == 'f'
+
+    try:
+        diabric.parallel.rolling(func, hosts, min_serving=len(hosts))
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+def test_venv_freeze():
+    '''
+    Freeze a fake venv whose pip writes a deprecation warning to stderr.
+    Check that the output and the saved requirements file hold only the
+    package lines.
+    '''
+    import diabric.venv
+    import tempfile
+
+    venv = tempfile.mkdtemp()
+    requirements = os.path.join(tempfile.mkdtemp(), 'requirements.txt')
+    os.mkdir(os.path.join(venv, 'bin'))
+    path = os.path.join(venv, 'bin', 'pip')
+    with open(path, 'w') as fh:
+        fh.write('#!/bin/sh\n'
+                 'echo "DEPRECATION: Python 2.7 will reach the end of its '
+                 'life." >&2\n'
+                 'echo Django==1.4.2\n'
+                 'echo boto==2.9.0\n')
+    os.chmod(path, 0755)
+
+    with patch_fabric(diabric.venv):
+        text = diabric.venv.freeze(venv, requirements)
+    assert text == 'Django==1.4.2\nboto==2.9.0\n'
+    with open(requirements) as fh:
+        assert fh.read() == text
+    assert diabric.venv.parse_freeze(text) == {'Django': '1.4.2',
+                                               'boto': '2.9.0'}
+
+
+def test_drift_report():
+    '''
+    Report the drift of pip freeze outputs from six hosts.  Check that the
+    most common output is the baseline and that each other group of hosts
+    lists the packages that differ from it.
+    '''
+    from diabric.venv import drift_report
+
+    base = 'Django==1.4.2\nboto==2.9.0\n'
+    freezes = {'a': base, 'b': base, 'c': base,
+               'd': 'Django==1.4.3\nboto==2.9.0\n',
+               'e': 'Django==1.4.2\nboto==2.9.0\nnose==1.3.0\n',
+               'f': 'Django==1.4.3\nboto==2.9.0\n'}
+    report = drift_report(freezes)
+    assert sorted(report[0][0]) == ['a', 'b', 'c']
+    assert report[0][1] == {}
+    drift = dict((tuple(sorted(hosts)), diffs) for hosts, diffs in report[1:])
+    assert drift == {('d', 'f'): {'Django': ('1.4.2', '1.4.3')},
+                     ('e',): {'nose': (None, '1.3.0')}}
+    assert drift_report({}) == []
+
+
+def test_inventory():
+    '''
+    Check that get_instances sends instance ids, filters and tags to EC2, and
+    that an Inventory reuses lookups, in memory and through its cache file,
+    until they expire.  Check that the on-host lookups use the default
+    inventory unless cached is False, and that terminating instances clears
+    it.
+    '''
+    import tempfile
+    from diabric import ec2
+
+    def connection():
+        return FakeEC2Connection([
+            FakeInstance('i-1', 'running', '2013-01-01T00:00:00.000Z'),
+            FakeInstance('i-2', 'running', '2013-02-01T00:00:00.000Z'),
+            FakeInstance('i-3', 'terminated', '2013-03-01T00:00:00.000Z'),
+        ])
+
+    conn = connection()
+    ec2.get_instances(conn=conn, instance_ids=['i-1'], filters={'a': 'b'},
+                      tags={'role': 'web'})
+    assert conn.calls == [('get_all_instances', ['i-1'],
+                           {'a': 'b', 'tag:role': 'web'})]
+
+    cache_file = os.path.join(tempfile.mkdtemp(), 'ec2.json')
+    conn = connection()
+    inventory = ec2.Inventory(ttl=60, cache_file=cache_file)
+    hosts = ec2.get_on_hosts(conn=conn, tags={'role': 'web'},
+                             inventory=inventory)
+    assert hosts == ['i-1.example.com', 'i-2.example.com']
+    assert ec2.get_latest_on_host(conn=conn, tags={'role': 'web'},
+                                  inventory=inventory) == 'i-2.example.com'
+    assert len(conn.calls) == 1
+
+    # a new inventory, e.g. in the next fab run, reuses the cache file.
+    inventory = ec2.Inventory(ttl=60, cache_file=cache_file)
+    assert ec2.get_on_hosts(conn=conn, tags={'role': 'web'},
+                            inventory=inventory) == hosts
+    assert len(conn.calls) == 1
+    ec2.get_on_hosts(conn=conn, tags={'role': 'db'}, inventory=inventory)
+    assert len(conn.calls) == 2
+
+    inventory = ec2.Inventory(ttl=-1)
+    ec2.get_on_hosts(conn=conn, inventory=inventory)
+    ec2.get_on_hosts(conn=conn, inventory=inventory)
+    assert len(conn.calls) == 4
+
+    # without an inventory, lookups are cached in the default inventory.
+    ec2.default_inventory.clear()
+    conn = connection()
+    ec2.get_on_hosts(conn=conn)
+    ec2.get_latest_on_host(conn=conn)
+    assert len(conn.calls) == 1
+    ec2.get_on_hosts(conn=conn, cached=False)
+    assert len(conn.calls) == 2
+
+    # terminating instances forgets the lookups that list them.
+    ec2.terminate_instances([conn.instances['i-1']], conn=conn)
+    assert ec2.get_on_hosts(conn=conn) == ['i-2.example.com']
+    assert len(conn.calls) == 4
+    ec2.get_on_hosts(conn=conn)
+    ec2.terminate_many(['i-2'], conn=conn, wait=False)
+    assert ec2.get_on_hosts(conn=conn) == []
+    ec2.default_inventory.clear()
+
+
+def test_region_instances():
+    '''
+    Look up instances and on hosts in three regions with fake connections.
+    Check that the regions are queried in separate threads, that the
+    results are merged in region order and labelled by region, that an
+    error in another region is returned without losing them, and that the
+    default regions are the ones enabled for the account.
+    '''
+    import threading
+    import time
+    from diabric import ec2
+
+    threads = set()
+    calls = []
+    arrived = threading.Condition()
+
+    class Connection(FakeEC2Connection):
+        def get_all_instances(self, instance_ids=None, filters=None):
+            # wait until all three regions are being queried at once.
+            with arrived:
+                threads.add(threading.current_thread().ident)
+                calls.append(self.region.name)
+                arrived.notify_all()
+                end = (len(calls) + 2) // 3 * 3
+                deadline = time.time() + 5
+                while len(calls) < end and time.time() < deadline:
+                    arrived.wait(0.1)
+            return FakeEC2Connection.get_all_instances(self, instance_ids,
+                                                       filters)
+
+        def get_all_regions(self):
+            # the regions enabled for the account.
+            return [FakeRegion(r) for r in regions]
+
+    def connect(region):
+        if region == 'cn-north-1':
+            raise ec2_error('AuthFailure', status=401)
+        if region is None:
+            return Connection()
+        return Connection([FakeInstance(region + '-1', region=region),
+                           FakeInstance(region + '-2', region=region)],
+                          region=region)
+
+    regions = ['us-east-1', 'us-west-2', 'eu-west-1']
+    pairs = ec2.get_region_instances(regions + ['cn-north-1'],
+                                     connect=connect)
+    assert len(threads) == 3
+    assert [(r, i.id) for r, i in pairs] == [
+        ('us-east-1', 'us-east-1-1'), ('us-east-1', 'us-east-1-2'),
+        ('us-west-2', 'us-west-2-1'), ('us-west-2', 'us-west-2-2'),
+        ('eu-west-1', 'eu-west-1-1'), ('eu-west-1', 'eu-west-1-2')]
+    assert pairs.errors.keys() == ['cn-north-1']
+    assert pairs.errors['cn-north-1'].error_code == 'AuthFailure'
+
+    inventory = ec2.Inventory()
+    hosts = ec2.get_region_on_hosts(connect=connect, inventory=inventory)
+    assert hosts[0] == ('us-east-1', 'us-east-1-1.example.com')
+    assert len(hosts) == 6 and not hosts.errors
+    assert len(inventory.cache) == 3
+
+
+def test_connection_registry():
+    '''
+    Check that throttled requests are retried until they succeed or the
+    retries run out, that other errors are not retried, and that a
+    TokenBucket limits the request rate.
+    '''
+    from boto.exception import EC2ResponseError
+    from diabric import ec2
+
+    class Connection(FakeEC2Connection):
+        def __init__(self, failures, code='RequestLimitExceeded'):
+            FakeEC2Connection.__init__(self)
+            self.failures = failures
+            self.code = code
+
+        def get_all_instances(self, instance_ids=None, filters=None):
+            if len(self.calls) < self.failures:
+                self.calls.append(('get_all_instances', instance_ids,
+                                   filters))
+                raise ec2_error(self.code, status=503)
+            return FakeEC2Connection.get_all_instances(self, instance_ids,
+                                                       filters)
+
+    clock = FakeClock()
+    old_time, ec2.time = ec2.time, clock
+    try:
+        registry = ec2.ConnectionRegistry(retries=3, delay=1, max_delay=3)
+        conn = Connection(failures=2)
+        assert len(registry.call(conn, 'get_all_instances')) == 1
+        assert len(conn.calls) == 3
+        assert 0.5 <= clock.sleeps[0] <= 1 and 1 <= clock.sleeps[1] <= 2
+
+        # give up after retries, and do not retry other errors.
+        for conn, calls in [(Connection(failures=10), 4),
+                            (Connection(failures=10, code='InvalidID'), 1)]:
+            try:
+                registry.call(conn, 'get_all_instances')
+            except EC2ResponseError:
+                pass
+            else:
+                assert False
+            assert len(conn.calls) == calls
+
+        # a burst of capacity requests, then rate requests per second.
+        bucket = ec2.TokenBucket(rate=10, capacity=5)
+        start = clock.now
+        for i in range(5):
+            bucket.acquire()
+        assert clock.now == start
+        for i in range(10):
+            bucket.acquire()
+        assert abs(clock.now - start - 1.0) < 1e-6
+    finally:
+        ec2.time = old_time
+
+
+def test_instance_index():
+    '''
+    Index instance records and look them up by id, state, tag and launch
+    time.  Check that sort_by_launch parses launch times and honours desc.
+    '''
+    import datetime
+    from diabric import ec2
+
+    def record(id, state, launch_time, role):
+        return ec2.InstanceRecord(id, state, launch_time, id + '.example.com',
+                                  {'role': role}, 'us-east-1')
+
+    records = [
+        record('i-1', 'running', '2013-03-01T00:00:00.000Z', 'web'),
+        record('i-2', 'running', '2013-01-01T00:00:00.000Z', 'web'),
+        record('i-3', 'terminated', '2013-04-01T00:00:00.000Z', 'web'),
+        record('i-4', 'stopped', '2013-02-01T00:00:00Z', 'db'),
+    ]
+    index = ec2.InstanceIndex(records)
+    assert len(index) == 4
+    assert index.get('i-3').state == 'terminated'
+    assert [r.id for r in index.state('running')] == ['i-2', 'i-1']
+    assert index.on_hosts('role', 'web') == ['i-2.example.com',
+                                             'i-1.example.com']
+    assert index.latest('role', 'web').id == 'i-1'
+    assert index.latest().id == 'i-1'
+    assert index.latest('role', 'cache') is None
+    launched = index.launched_between(datetime.datetime(2013, 2, 1),
+                                      datetime.datetime(2013, 3, 1))
+    assert [r.id for r in launched] == ['i-4', 'i-1']
+
+    assert [r.id for r in ec2.sort_by_launch(records, desc=True)] == [
+        'i-3', 'i-1', 'i-4', 'i-2']
+
+
+def test_terminate_many():
+    '''
+    Terminate instances in chunks with a fake connection.  Check that an
+    invalid id fails only itself, that an error in one chunk fails only
+    that chunk, and that states are polled with one describe per chunk.
+    '''
+    import socket
+    from diabric import ec2
+
+    class Connection(FakeEC2Connection):
+        def __init__(self, instances, broken=None):
+            FakeEC2Connection.__init__(self, instances)
+            self.broken = broken
+
+        def get_all_instances(self, instance_ids=None, filters=None):
+            if self.broken in instance_ids:
+                raise socket.error('Connection reset by peer')
+            return FakeEC2Connection.get_all_instances(self, instance_ids,
+                                                       filters)
+
+    ids = ['i-{}'.format(n) for n in range(5)]
+    conn = Connection([FakeInstance(i) for i in ids])
+    results = ec2.terminate_many(ids + ['i-bad'], conn=conn, chunk_size=2,
+                                 delay=0.001)
+    assert list(results) == ids + ['i-bad']
+    for i in ids:
+        assert results[i].succeeded and results[i].state == 'terminated'
+    assert not results['i-bad'].succeeded
+    assert results['i-bad'].error.error_code == 'InvalidInstanceID.NotFound'
+    # one describe per chunk and poll, not one per instance.
+    describes = [c[1] for c in conn.calls if c[0] == 'get_all_instances']
+    assert sorted(len(d) for d in describes) == [1, 1, 2, 2, 2, 2]
+
+    conn = Connection([FakeInstance(i) for i in ids])
+    results = ec2.terminate_many(ids[:2], conn=conn, wait=False)
+    assert [r.state for r in results.values()] == ['shutting-down'] * 2
+
+    # an error polling one chunk does not lose the results of the others.
+    conn = Connection([FakeInstance(i) for i in ids], broken='i-2')
+    results = ec2.terminate_many(ids[:4], conn=conn, chunk_size=2,
+                                 delay=0.001)
+    assert [r.succeeded for r in results.values()] == [True, True,
+                                                       False, False]
+    assert isinstance(results['i-2'].error, socket.error)
+    assert results['i-2'].state == 'shutting-down'
+
 